@@ -3,9 +3,11 @@ import os
 import gc
 import math
 import atexit
+import queue
 import bisect
 import random
-import itertools as it
+import collections
+import concurrent.futures
 
 import pymunk
 
@@ -17,6 +19,11 @@ import cocos
 from cocos.actions import *
 from cocos.scenes.transitions import *
 
+from geometry import (Rect, bb2cells, bb2range, cells2rect, pack_rects, rect2bb, rect2cells, 
+    rect_distances, rects_containing, rects_overlap)
+from world import (ChunkCache, ChunkRecord, ChunkWorker, FrameScheduler, OccupancyIndex, Pool, 
+    SpatialHash, rect_containing)
+
 
 pyglet.resource.path.extend([
     "./data/fonts", 
@@ -67,7 +74,12 @@ DECORATION_TYPE = 2
 REWARD_TYPE = 3
 TRAP_TYPE = 4
 
-STEP = 1 / 60
+PHYSICS_RATE = 60
+MAX_SUBSTEPS = 5
+STEP = 1 / PHYSICS_RATE
+STATIC_GEOMETRY = True
+SPATIAL_HASH = False
+SPATIAL_HASH_COUNT = 1000
 
 
 GRASS_STYLE = {
@@ -176,6 +188,66 @@ def _ScrollableLayer_on_exit_patch(self):
 cocos.layer.ScrollableLayer.on_exit = _ScrollableLayer_on_exit_patch
 
 
+def split_children(node, children):
+    children = set(children)
+    kept = [(z, child) for z, child in node.children if child not in children]
+    if len(node.children) - len(kept) != len(children):
+        found = {child for z, child in node.children}
+        raise ValueError(f"{len(children - found)} children not found in {node!r}")
+    return kept, children
+
+def detach_children(node, kept, children):
+    node.children = kept
+    for child in children:
+        if isinstance(node, cocos.batch.BatchNode):
+            child.set_batch(None)
+        if node.is_running:
+            child.on_exit()
+
+
+class CullingLayer(cocos.layer.ScrollableLayer):
+    def __init__(self, index):
+        super().__init__()
+        self.index = index
+        self.view_bounds = None
+        self.drawn = set()
+
+    def add(self, child, z=0, name=None, bb=None):
+        super().add(child, z, name)
+        if bb is not None:
+            child.visible = False
+            self.index.insert(child, bb)
+            self.view_bounds = None
+
+    def remove(self, obj):
+        super().remove(obj)
+        if obj in self.index:
+            self.index.remove(obj)
+            self.drawn.discard(obj)
+
+    def get_counts(self):
+        total = len(self.children)
+        return total - len(self.index) + len(self.drawn), total
+
+    def cull(self):
+        bb = (self.view_x, self.view_y, 
+            self.view_x + self.view_w, self.view_y + self.view_h)
+        bounds = self.index.get_cells(bb)
+        if bounds == self.view_bounds:
+            return
+        self.view_bounds = bounds
+        drawn = self.index.query(bb)
+        for node in self.drawn - drawn:
+            node.visible = False
+        for node in drawn - self.drawn:
+            node.visible = True
+        self.drawn = drawn
+
+    def visit(self):
+        self.cull()
+        super().visit()
+
+
 class Mixer:
     def __init__(self):
         self.queue = []
@@ -367,16 +439,53 @@ class MenuScene(cocos.scene.Scene):
         super().on_exit()
 
 
+EntityEntry = collections.namedtuple("EntityEntry", "entity layer sprites shapes objects")
+
+
+def create_space(spatial_hash=SPATIAL_HASH):
+    space = pymunk.Space()
+    space.gravity = (0, -900)
+    space.damping = 0.75
+    if spatial_hash:
+        space.use_spatial_hash(TILEWIDTH * SCALE, SPATIAL_HASH_COUNT)
+    return space
+
+
 class Entity(pymunk.Body):
+    physical = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # self._sprites = cocos.layer.ScrollableLayer()
         self._sprites = set()
+        self.tiles = ()
+        self.tile_keys = []
+        self.tile_sprites = []
 
     @property
     def sprites(self):
         return self._sprites
 
+    def get_shapes(self):
+        return (self.shape,)
+
+    def set_tiles(self, tiles, pool=None, **kwargs):
+        self.tiles = tiles
+        self.tile_keys = [index for row, column, index in tiles]
+        self.tile_sprites = [*create_tiles(tiles, pool, **kwargs)]
+        self.sprites.update(self.tile_sprites)
+
+    def reset(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
+        pass
+
+    def release(self, pool):
+        for key, sprite in zip(self.tile_keys, self.tile_sprites):
+            pool.release(key, sprite)
+            self.sprites.discard(sprite)
+        self.tiles = ()
+        self.tile_keys = []
+        self.tile_sprites = []
+
 
 class Player(Entity):
     def __init__(self, idle_right, walk_right, jump_right, dead_right, **kwargs):
@@ -407,6 +516,7 @@ class Player(Entity):
         self.face2right = True
         self.on_ground = False
         self.hearts = 3
+        self.previous_position = self.position
 
     def damage(self, amount):
         if amount > 0 and self.hearts > 0:
@@ -419,11 +529,8 @@ class Player(Entity):
         if self.sprite.image is not image:
             self.sprite.image = image
 
-    def update(self, dt):
-        x, y = self.position
-        scroller.set_focus(x, y)
-        self.sprite.position = x, y
-
+    def step(self, dt):
+        self.previous_position = self.position
         vx, vy = self.velocity
         if self.hearts > 0 and abs(vx) < 500:
             force = pymunk.Vec2d.zero()
@@ -434,6 +541,12 @@ class Player(Entity):
                 force += pymunk.Vec2d(fx, 0)
             self.apply_force_at_local_point(force)
 
+    def update(self, dt, alpha=1):
+        x, y = self.previous_position.interpolate_to(self.position, alpha)
+        scroller.set_focus(x, y)
+        self.sprite.position = x, y
+
+        vx, vy = self.velocity
         if not self.on_ground:
             self.change_image(self.jump_right if self.face2right else self.jump_left)
         elif self.hearts <= 0:
@@ -477,139 +590,173 @@ class Player(Entity):
         self.on_ground = False
 
 
-def create_tile(row, column, image, **kwargs):
-    sprite = cocos.sprite.Sprite(image, **kwargs)
+def place_tile(sprite, row, column):
     rect = sprite.get_AABB()
     rect.position = column * sprite.width, row * sprite.height
     sprite.position = rect.center 
+
+
+def create_tile(row, column, image, pool=None, key=None, **kwargs):
+    sprite = None if pool is None else pool.acquire(key)
+    if sprite is None:
+        sprite = cocos.sprite.Sprite(image, **kwargs)
+    place_tile(sprite, row, column)
+    return sprite
+
+
+def create_tiles(tiles, pool=None, **kwargs):
+    for row, column, index in tiles:
+        yield create_tile(row, column, IMAGES[index], pool, index, **kwargs)
+
+
+TILE_DATA = {}
+BLOCK_TEXTURES = {}
+
+def get_tile_data(index):
+    data = TILE_DATA.get(index)
+    if data is None:
+        data = TILE_DATA[index] = IMAGES[index].get_image_data()
+    return data
+
+
+def bake_tiles(key):
+    texture = BLOCK_TEXTURES.get(key)
+    if texture is None:
+        rows = 1 + max(row for row, column, index in key)
+        columns = 1 + max(column for row, column, index in key)
+        texture = pyglet.image.Texture.create(columns * TILEWIDTH, rows * TILEHEIGHT)
+        for row, column, index in key:
+            texture.blit_into(get_tile_data(index), column * TILEWIDTH, row * TILEHEIGHT, 0)
+        BLOCK_TEXTURES[key] = texture
+    return texture
+
+
+def place_block(sprite, row, column):
+    rect = sprite.get_AABB()
+    rect.position = column * TILEWIDTH * sprite.scale, row * TILEHEIGHT * sprite.scale
+    sprite.position = rect.center
+
+
+def create_block(row, column, key, pool=None, **kwargs):
+    sprite = None if pool is None else pool.acquire(key)
+    if sprite is None:
+        sprite = cocos.sprite.Sprite(bake_tiles(key), **kwargs)
+    place_block(sprite, row, column)
     return sprite
 
 
+def bb2vertices(bb):
+    left, bottom, right, top = bb
+    return [(right, bottom), (right, top), (left, top), (left, bottom)]
+
+
 class Ground(Entity):
-    def __init__(self, bb, shape_bb, style, **kwargs):
+    def __init__(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
         super().__init__(body_type=pymunk.Body.STATIC)
         self.shape = pymunk.Poly.create_box_bb(self, shape_bb)
         self.shape.collision_type = GROUND_TYPE
         self.shape.friction = 0.5
+        self.set_tiles(tiles, pool, **kwargs)
 
-        left, bottom, right, top = map(round, bb)
-        width, height = right - left, top - bottom
-        y, x = random.choice(style["ground"])
-        if width > 1:
-            if height > 1:
-                self.sprites.add(create_tile(top - 1, left, IMAGES[(y + 3, x + 0)], **kwargs))
-                self.sprites.add(create_tile(bottom, left, IMAGES[(y + 1, x)], **kwargs))
-                self.sprites.add(create_tile(bottom, right - 1, IMAGES[(y + 1, x + 2)], **kwargs))
-                self.sprites.add(create_tile(top - 1, right - 1, IMAGES[(y + 3, x + 2)], **kwargs))
-                for column in range(left + 1, right -1):
-                    self.sprites.add(create_tile(top - 1, column, IMAGES[(y + 3, x + 1)], **kwargs))
-                    self.sprites.add(create_tile(bottom, column, IMAGES[(y + 1, x + 1)], **kwargs))
-                for row in range(bottom + 1, top - 1):
-                    self.sprites.add(create_tile(row, left, IMAGES[(y + 2, x + 0)], **kwargs))
-                    self.sprites.add(create_tile(row, right - 1, IMAGES[(y + 2, x + 2)], **kwargs))
-                for row, column in it.product(range(bottom + 1, top - 1), range(left + 1, right -1)):
-                    image = IMAGES[random.choice([(y + 2, x + 1), 
-                        (y + 0, x + 4), (y + 1, x + 4), (y + 2, x + 4), (y + 3, x + 4)])]
-                    self.sprites.add(create_tile(row, column, image, **kwargs))
-            else:
-                self.sprites.add(create_tile(bottom , left, IMAGES[(y + 0, x + 0)], **kwargs))
-                self.sprites.add(create_tile(bottom, right - 1, IMAGES[(y + 0, x + 2)], **kwargs))
-                for column in range(left + 1, right - 1):
-                    self.sprites.add(create_tile(bottom, column, IMAGES[(y + 0, x + 1)], **kwargs))
-        elif height > 1:
-            self.sprites.add(create_tile(bottom, left, IMAGES[(y + 1, x + 3)], **kwargs))
-            self.sprites.add(create_tile(top - 1, left, IMAGES[(y + 3, x + 3)], **kwargs))
-            for row in range(bottom + 1, top - 1):
-                self.sprites.add(create_tile(row, left, IMAGES[(y + 2, x + 3)], **kwargs))
-        else:
-            self.sprites.add(create_tile(bottom, left, IMAGES[(y + 0, x + 3)], **kwargs))
+    def reset(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
+        self.shape.unsafe_set_vertices(bb2vertices(shape_bb))
+        self.set_tiles(tiles, pool, **kwargs)
+
+    def set_tiles(self, tiles, pool=None, **kwargs):
+        bottom = min(row for row, column, index in tiles)
+        left = min(column for row, column, index in tiles)
+        key = tuple((row - bottom, column - left, index) for row, column, index in tiles)
+        sprite = create_block(bottom, left, key, pool, **kwargs)
+        self.tiles = tiles
+        self.tile_keys = [key]
+        self.tile_sprites = [sprite]
+        self.sprites.add(sprite)
 
 
 class Decoration(Entity):
-    def __init__(self, bb, shape_bb, style,**kwargs):
+    def __init__(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
         super().__init__(body_type=pymunk.Body.STATIC)
         self.shape = pymunk.Poly.create_box_bb(self, shape_bb)
         self.shape.collision_type = DECORATION_TYPE
         self.shape.sensor = True
+        self.set_tiles(tiles, pool, **kwargs)
+
+    def reset(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
+        self.shape.unsafe_set_vertices(bb2vertices(shape_bb))
+        self.set_tiles(tiles, pool, **kwargs)
 
 
 class DecorationTop(Decoration):
-    def __init__(self, bb, shape_bb, style, **kwargs):
-        super().__init__(bb, shape_bb, style, **kwargs)
-        left, bottom, right, top = map(round, bb)
-        width, height = right - left, top - bottom
-        if height == 1:
-            image = IMAGES[random.choice(style["top_deco"])]
-            self.sprites.add(create_tile(bottom, left, image, **kwargs))
-        elif height == 2:
-            if random.uniform(0, 1) < 0.3:
-                bottom_image = IMAGES[random.choice(style["top_deco1"])]
-                top_image = IMAGES[random.choice(style["top_deco2"])]
-                self.sprites.add(create_tile(bottom, left, bottom_image, **kwargs))
-                self.sprites.add(create_tile(bottom + 1, left, top_image, **kwargs))
-            else:
-                image = IMAGES[random.choice(style["top_deco"])]
-                self.sprites.add(create_tile(bottom, left, image, **kwargs))
+    pass
 
 
 class DecorationBottom(Decoration):
-    def __init__(self, bb, shape_bb, style, **kwargs):
-        super().__init__(bb, shape_bb, style, **kwargs)
-        left, bottom, right, top = map(round, bb)
-        width, height = right - left, top - bottom
-        if height == 1:
-            image = IMAGES[random.choice(style["bottom_deco"])]
-            self.sprites.add(create_tile(top - 1, left, image, **kwargs))
-        elif height == 2:
-            if random.uniform(0, 1) < 0.3:
-                top_image = IMAGES[random.choice(style["bottom_deco1"])]
-                bottom_image = IMAGES[random.choice(style["bottom_deco2"])]
-                self.sprites.add(create_tile(top - 1, left, top_image, **kwargs))
-                self.sprites.add(create_tile(top - 2, left, bottom_image, **kwargs))
-            else:
-                image = IMAGES[random.choice(style["bottom_deco"])]
-                self.sprites.add(create_tile(top - 1, left, image, **kwargs))
+    pass
 
 
 class Reward(Entity):
     value = 1
-    def __init__(self, bb, shape_bb, **kwargs):
+    physical = False
+
+    def __init__(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
         super().__init__(body_type=pymunk.Body.STATIC)
         shape_bb = pymunk.BB(*shape_bb)
         width = shape_bb.right - shape_bb.left
         self.shape = pymunk.Circle(self, width / 4, shape_bb.center())
         self.shape.collision_type = REWARD_TYPE
         self.shape.sensor = True
+        self.collected = False
+
+    def reset(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
+        self.collected = False
+        shape_bb = pymunk.BB(*shape_bb)
+        width = shape_bb.right - shape_bb.left
+        self.shape.unsafe_set_radius(width / 4)
+        self.shape.unsafe_set_offset(shape_bb.center())
+        left, bottom, right, top = map(round, bb)
+        place_tile(self.sprite, bottom, left)
 
 
 class Gem(Reward):
-    def __init__(self, bb, shape_bb, **kwargs):
+    def __init__(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
         super().__init__(bb, shape_bb, **kwargs)
         left, bottom, right, top = map(round, bb)
-        self.sprites.add(create_tile(bottom, left, 
-            IMAGES[14, 2], **kwargs))
+        self.sprite = create_tile(bottom, left, 
+            IMAGES[14, 2], **kwargs)
+        self.sprites.add(self.sprite)
         self.value = 1
 
 class Diamond(Reward):
-    def __init__(self, bb, shape_bb, **kwargs):
+    def __init__(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
         super().__init__(bb, shape_bb, **kwargs)
         left, bottom, right, top = map(round, bb)
-        self.sprites.add(create_tile(bottom, left, 
-            sequence2animation((IMAGES[15, 2], IMAGES[16, 2]), 0.2), **kwargs))
+        self.sprite = create_tile(bottom, left, 
+            sequence2animation((IMAGES[15, 2], IMAGES[16, 2]), 0.2), **kwargs)
+        self.sprites.add(self.sprite)
         self.value = 5
 
 
+def trap2vertices(bb):
+    left, bottom, right, top = bb
+    return bb2vertices((left, bottom, right, (bottom + top) / 2))
+
+
 class Trap(Entity):
-    def __init__(self, bb, shape_bb, **kwargs):
+    def __init__(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
         super().__init__(body_type=pymunk.Body.STATIC)
         left, bottom, right, top = shape_bb
         shape_bb = pymunk.BB(left, bottom, right, (bottom + top) / 2)
         self.shape = pymunk.Poly.create_box_bb(self, shape_bb, -15)
         self.shape.collision_type = TRAP_TYPE
 
+    def reset(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
+        self.shape.unsafe_set_vertices(trap2vertices(shape_bb))
+        left, bottom, right, top = bb
+        place_tile(self.sprite, bottom, left)
+
 
 class StaticTrap(Trap):
-    def __init__(self, bb, shape_bb, **kwargs):
+    def __init__(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
         super().__init__(bb, shape_bb, **kwargs)
         left, bottom, right, top = bb
         self.sprite = create_tile(bottom, left, IMAGES[13, 2], **kwargs)
@@ -617,19 +764,39 @@ class StaticTrap(Trap):
 
 
 class HiddenTrap(Trap):
-    def __init__(self, bb, shape_bb, **kwargs):
+    def __init__(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
         super().__init__(bb, shape_bb, **kwargs)
         left, bottom, right, top = bb
         self.sprite = create_tile(bottom, left, IMAGES[9, 3], **kwargs)
         self.sprites.add(self.sprite)
+        self.revealed = False
+
+    def reset(self, bb, shape_bb, tiles=(), pool=None, **kwargs):
+        super().reset(bb, shape_bb, tiles, pool, **kwargs)
+        self.revealed = False
+        if self.sprite.image is not IMAGES[9, 3]:
+            self.sprite.image = IMAGES[9, 3]
+
+    def reveal(self):
+        self.revealed = True
+        self.sprite.image = IMAGES[10, 3]
+
+
+ENTITY_TYPES = {
+    "ground": Ground,
+    "decoration_top": DecorationTop,
+    "decoration_bottom": DecorationBottom,
+    "gem": Gem,
+    "diamond": Diamond,
+    "static_trap": StaticTrap,
+    "hidden_trap": HiddenTrap,
+}
 
 
 def bb2tiles(bb, width=16, height=16):
-    starts, stops = zip(*[iter(bb)] * 2)
-    left, bottom = map(lambda x: math.floor(x / width), starts)
-    right, top = map(lambda y: math.ceil(y / height), stops)
-    for column in range(left, right):
-        for row in range(bottom, top):
+    row_start, row_stop, column_start, column_stop = bb2range(bb, width, height)
+    for column in range(column_start, column_stop):
+        for row in range(row_start, row_stop):
             yield row, column
 
 def tiles2chunks(tiles, rows, columns):
@@ -640,7 +807,10 @@ def tiles2chunks(tiles, rows, columns):
             yield rq, cq
 
 def bb2chunks(bb, rows=3, columns=3, width=16, height=16):
-    yield from tiles2chunks(bb2tiles(bb, width, height), rows, columns)
+    row_start, row_stop, column_start, column_stop = bb2cells(bb, rows, columns, width, height)
+    for column in range(column_start, column_stop):
+        for row in range(row_start, row_stop):
+            yield row, column
 
 def chunks2tiles(chunks, rows=3, columns=3):
     for row, column in chunks:
@@ -652,140 +822,248 @@ def tiles2bb(tiles, width=16, height=16):
     return left * width, bottom * height, (right + 1) * width, (top + 1) * height
 
 def chunks2bb(chunks, rows=3, columns=3, width=16, height=16):
-    yield from tiles2bb(chunks2tiles(chunks, rows, columns), width, height)
+    if not isinstance(chunks, Rect):
+        chunks = cells2rect(chunks)
+    return rect2bb(chunks, rows, columns, width, height)
 
 
 def get_chunk_containing(row, column, rows=3, columns=3):
-    for w, h in it.product(range(1, columns + 1), range(1, rows + 1)):
-        for i, j in it.product(range(h), range(w)):
-            yield frozenset(it.product(range(row - i, row + h - i), range(column - j, column + w - j)))
+    for rect in rects_containing(row, column, rows, columns):
+        yield rect2cells(rect)
 
 
 class WorldGenerator:
+    node_type = cocos.batch.BatchNode
+
     def __init__(self, game_scene, chunk_rows=3, 
-        chunk_columns=3, tile_width=16, tile_height=16):
+        chunk_columns=3, tile_width=16, tile_height=16, prefetch=1, 
+        budget=4.0, teardown_batch=8, seed=None, cache_size=256):
         self.game_scene = game_scene
+        self.seed = random.getrandbits(64) if seed is None else seed
         self.chunk_rows = chunk_rows
         self.chunk_columns = chunk_columns
         self.tile_width = tile_width
         self.tile_height = tile_height
+        self.prefetch = prefetch
+        self.teardown_batch = teardown_batch
         self.chunks = {}
+        self.nodes = {}
+        self.pending = {}
+        self.queued = {}
+        self.dying = {}
+        self.ready = queue.SimpleQueue()
+        self.center = (0, 0)
+        self.descriptions = {}
+        self.items = {}
+        self.occupancy = OccupancyIndex()
+        self.cache = ChunkCache(cache_size)
+        self.scheduler = FrameScheduler(budget)
+        self.worker = ChunkWorker(chunk_rows, chunk_columns, self.seed)
+        self.entity_pool = Pool()
+        self.sprite_pool = Pool()
 
     def update(self, bb):
         left, bottom, right, top = bb
-        xpad = self.chunk_columns * self.tile_width
-        ypad = self.chunk_rows * self.tile_height
+        self.center = ((left + right) / 2, (bottom + top) / 2)
+        xpad = (1 + self.prefetch) * self.chunk_columns * self.tile_width
+        ypad = (1 + self.prefetch) * self.chunk_rows * self.tile_height
         new_bb = left - xpad, bottom - ypad, right + xpad, top + ypad
-        target = set(bb2chunks(new_bb, 
+        bounds = bb2cells(new_bb, 
             self.chunk_rows, self.chunk_columns, 
-            self.tile_width, self.tile_height))
-        for chunk in tuple(self.chunks.keys()):
-            if target.isdisjoint(chunk):
-                self.delete_chunk(chunk)
-                del self.chunks[chunk]
-        missing = target.difference(*self.chunks.keys())
-        while missing:
-            row, column = missing.pop()
-            options = [*get_chunk_containing(row, column, 3, 3)]
-            random.shuffle(options)
-            while True:
-                chunk = options.pop()
-                if all(map(chunk.isdisjoint, self.chunks.keys())):
-                    missing.difference_update(chunk)
-                    self.chunks[chunk] = []
-                    self.create_chunk(chunk)
-                    break
-
-    def create_chunk(self, chunk):
-        left, bottom, right, top = chunks2bb(chunk, 
-            self.chunk_rows, self.chunk_columns, 1, 1)
-        width, height = right - left, top - bottom
-
-        new_left = random.randint(left + 1, min(left + 2, right - 2))
-        new_right = random.randint(max(new_left, right - 1), right - 1)
-
-        bottom_top = random.randint(bottom + 1, min(bottom + 3, top - 2))
-        top_bottom = random.randint(max(bottom_top + 1, top - 2), top - 1)
-
-        bottom_bb = (new_left, bottom, new_right, bottom_top)
-        ground_bb = (new_left, bottom_top, new_right, top_bottom)
-        top_bb = (new_left, top_bottom, new_right, top)
-
-        self.populate_top(chunk, top_bb)
-        self.create_ground(chunk, ground_bb)
-        self.populate_bottom(chunk, bottom_bb)
+            self.tile_width, self.tile_height)
+        stale, missing = self.occupancy.update(bounds)
+        for chunk in stale:
+            self.delete_chunk(chunk)
+            self.occupancy.remove(chunk)
+        for row, column in missing:
+            if (row, column) in self.occupancy:
+                continue
+            chunk = rect_containing(row, column, self.seed, 3, 3)
+            self.occupancy.place(chunk)
+            self.chunks[chunk] = []
+            record = self.cache.pop(chunk)
+            if record is not None:
+                self.queued[chunk] = self.scheduler.push(self.get_priority(chunk), 
+                    self.create_chunk, record.description, record)
+                continue
+            future = self.worker.submit(chunk, self.game_scene.style)
+            self.pending[chunk] = future
+            future.add_done_callback(self.ready.put)
+        self.collect()
+        self.scheduler.run()
+
+    def collect(self):
+        futures = []
+        while True:
+            try:
+                futures.append(self.ready.get_nowait())
+            except queue.Empty:
+                break
+        self.schedule(futures)
+
+    def schedule(self, futures):
+        descriptions = []
+        for future in futures:
+            if future.cancelled():
+                continue
+            description = future.result()
+            if self.pending.get(description.chunk) is future:
+                del self.pending[description.chunk]
+                descriptions.append(description)
+        if not descriptions:
+            return
+        priorities = rect_distances(pack_rects(description.chunk for description in descriptions), 
+            *self.center, self.chunk_rows, self.chunk_columns, self.tile_width, self.tile_height)
+        for description, priority in zip(descriptions, priorities):
+            self.queued[description.chunk] = self.scheduler.push(
+                priority, self.create_chunk, description)
+
+    def get_priority(self, chunk):
+        left, bottom, right, top = rect2bb(chunk, self.chunk_rows, self.chunk_columns, 
+            self.tile_width, self.tile_height)
+        x, y = self.center
+        return ((left + right) / 2 - x) ** 2 + ((bottom + top) / 2 - y) ** 2
+
+    def flush(self):
+        done, _ = concurrent.futures.wait(tuple(self.pending.values()))
+        self.schedule(done)
+        self.collect()
+        self.scheduler.run(math.inf)
+
+    def close(self):
+        self.worker.close()
+        for chunk in [chunk for chunk in self.chunks if chunk not in self.nodes]:
+            future = self.pending.pop(chunk, None)
+            if future is not None:
+                future.cancel()
+            entry = self.queued.pop(chunk, None)
+            if entry is not None:
+                self.scheduler.cancel(entry)
+            del self.chunks[chunk]
+            self.occupancy.release(chunk)
+
+    def discard(self):
+        self.close()
+        self.cache.close()
+
+    def get_stats(self):
+        return {
+            "entity_hit_rate": self.entity_pool.hit_rate,
+            "entity_pool_size": len(self.entity_pool),
+            "sprite_hit_rate": self.sprite_pool.hit_rate,
+            "sprite_pool_size": len(self.sprite_pool),
+            "cached_chunks": len(self.cache),
+            **{f"cache_{key}": value for key, value in self.cache.stats.items()},
+        }
+
+    def create_chunk(self, description, state=None):
+        del self.queued[description.chunk]
+        for chunk in tuple(self.dying):
+            if rects_overlap(chunk, description.chunk):
+                self.teardown(chunk, math.inf)
+        self.descriptions[description.chunk] = description
+        entities = self.chunks[description.chunk]
+        node = self.nodes[description.chunk] = self.node_type()
+        items = self.items[description.chunk] = {}
+        for index, record in enumerate(description.entities):
+            if state is not None and index in state.collected:
+                entities.append(None)
+                continue
+            entity = self.create_entity(record)
+            if state is not None and index in state.revealed:
+                entity.reveal()
+            if not entity.physical:
+                left, bottom, right, top = map(round, record.bb)
+                entity.shape.cache_bb()
+                items[bottom, left] = entity
+            entities.append(entity)
+        self.game_scene.add_entities(*filter(None, entities), layer=node)
+        self.game_scene.scrollable.add(node, bb=rect2bb(description.chunk, 
+            self.chunk_rows, self.chunk_columns, self.tile_width, self.tile_height))
+
+    def create_entity(self, record):
+        left, bottom, right, top = record.bb
+        true_bb = (left * self.tile_width, bottom * self.tile_height, 
+            right * self.tile_width, top * self.tile_height)
+        cls = ENTITY_TYPES[record.kind]
+        entity = self.entity_pool.acquire(cls)
+        if entity is None:
+            return cls(record.bb, true_bb, record.tiles, self.sprite_pool, scale=SCALE)
+        entity.reset(record.bb, true_bb, record.tiles, self.sprite_pool, scale=SCALE)
+        return entity
+
+    def release_entity(self, entity):
+        entity.release(self.sprite_pool)
+        self.entity_pool.release(type(entity), entity)
+
+    def query_items(self, bb):
+        row_start, row_stop, column_start, column_stop = bb2range(bb, 
+            self.tile_width, self.tile_height)
+        for row in range(row_start, row_stop):
+            for column in range(column_start, column_stop):
+                chunk = self.occupancy.get_owner(
+                    (row // self.chunk_rows, column // self.chunk_columns))
+                item = self.items[chunk].get((row, column)) if chunk in self.items else None
+                if item is not None:
+                    yield item
 
     def delete_chunk(self, chunk):
-        self.game_scene.remove_entities(*self.chunks[chunk])
-        # bb = pymunk.BB(*chunks2bb(chunk, self.chunk_rows, self.chunk_columns, 
-        #     self.tile_width, self.tile_height))
-        # for shape in self.game_scene.space.bb_query(bb, pymunk.ShapeFilter()):
-        #     self.game_scene.remove_entity(shape.body)
-
-    def create_ground(self, chunk, bb):
-        true_bb = (bb[0] * self.tile_width, bb[1] * self.tile_height, 
-            bb[2] * self.tile_width, bb[3] * self.tile_height)
-        entity = Ground(bb, true_bb, self.game_scene.style, scale=SCALE)
-        self.game_scene.add_entity(entity)
-        self.chunks[chunk].append(entity)
-
-    def populate_top(self, chunk, bb):
-        left, bottom, right, top = map(round, bb)
-        for column in range(left, right):
-            u = random.uniform(0, 1) 
-            if u < 0.3:
-                decoration_bb = (column, bottom, column + 1, top)
-                true_bb = (decoration_bb[0] * self.tile_width, decoration_bb[1] * self.tile_height, 
-                    decoration_bb[2] * self.tile_width, decoration_bb[3] * self.tile_height)
-                entity = DecorationTop(decoration_bb, true_bb, self.game_scene.style, scale=SCALE)
-                self.game_scene.add_entity(entity)
-                self.chunks[chunk].append(entity)
-            elif u < 0.7:
-                reward_bb = (column, bottom, column + 1, bottom + 1)
-                true_bb = (reward_bb[0] * self.tile_width, reward_bb[1] * self.tile_height, 
-                    reward_bb[2] * self.tile_width, reward_bb[3] * self.tile_height)
-                if u < 0.6:
-                    entity = Gem(reward_bb, true_bb, scale=SCALE)
-                else:
-                    entity = Diamond(reward_bb, true_bb, scale=SCALE)
-                self.game_scene.add_entity(entity)
-                self.chunks[chunk].append(entity)
-            elif u < 0.75:
-                trap_bb = (column, bottom, column + 1, bottom + 1)
-                true_bb = (trap_bb[0] * self.tile_width, trap_bb[1] * self.tile_height, 
-                    trap_bb[2] * self.tile_width, trap_bb[3] * self.tile_height)
-                if u < 0.735:
-                    entity = StaticTrap(trap_bb, true_bb, scale=SCALE)
-                else:
-                    entity = HiddenTrap(trap_bb, true_bb, scale=SCALE)
-                self.game_scene.add_entity(entity)
-                self.chunks[chunk].append(entity)
-
-    def populate_bottom(self, chunk, bb):
-        left, bottom, right, top = map(round, bb)
-        for column in range(left, right):
-            if random.uniform(0, 1) < 0.2:
-                decoration_bb = (column, bottom, column + 1, top)
-                true_bb = (decoration_bb[0] * self.tile_width, decoration_bb[1] * self.tile_height, 
-                    decoration_bb[2] * self.tile_width, decoration_bb[3] * self.tile_height)
-                entity = DecorationBottom(decoration_bb, true_bb, self.game_scene.style, scale=SCALE)
-                self.game_scene.add_entity(entity)
-                self.chunks[chunk].append(entity)
+        future = self.pending.pop(chunk, None)
+        if future is not None:
+            future.cancel()
+        entry = self.queued.pop(chunk, None)
+        if entry is not None:
+            self.scheduler.cancel(entry)
+        entities = self.chunks.pop(chunk)
+        self.items.pop(chunk, None)
+        node = self.nodes.pop(chunk, None)
+        if node is not None:
+            self.game_scene.scrollable.remove(node)
+        description = self.descriptions.pop(chunk, None)
+        if description is not None:
+            self.cache.put(chunk, ChunkRecord(description, 
+                frozenset(i for i, entity in enumerate(entities) 
+                    if entity is None or getattr(entity, "collected", False)),
+                frozenset(i for i, entity in enumerate(entities) 
+                    if getattr(entity, "revealed", False))))
+        self.dying.setdefault(chunk, []).extend(filter(None, entities))
+        self.scheduler.push(math.inf, self.teardown, chunk, self.teardown_batch)
+
+    def teardown(self, chunk, count):
+        entities = self.dying.get(chunk)
+        if entities is None:
+            return
+        batch = [entities.pop() for _ in range(min(count, len(entities)))]
+        self.game_scene.remove_entities(*filter(self.game_scene.has_entity, batch), 
+            sprites=False)
+        for entity in batch:
+            self.release_entity(entity)
+        if entities:
+            self.scheduler.push(math.inf, self.teardown, chunk, count)
+        else:
+            del self.dying[chunk]
 
 
 class GameScene(cocos.scene.Scene):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, rate=PHYSICS_RATE, max_substeps=MAX_SUBSTEPS, 
+        static_geometry=STATIC_GEOMETRY, spatial_hash=SPATIAL_HASH, **kwargs):
         super().__init__(*args, **kwargs)
 
+        self.timestep = 1 / rate
+        self.max_substeps = max_substeps
+        self.accumulator = 0
+
         global scroller
         scroller = cocos.layer.ScrollingManager()
-        self.scrollable = cocos.layer.ScrollableLayer()
+        self.scrollable = CullingLayer(SpatialHash(3, 3, 
+            TILEWIDTH * SCALE, TILEHEIGHT * SCALE))
         scroller.add(self.scrollable)
         self.add(scroller)
 
-        self.space = pymunk.Space()
-        self.space.gravity = (0, -900)
-        self.space.damping = 0.75
+        self.space = create_space(spatial_hash)
+        self.static_geometry = static_geometry
+        self.registry = {}
+        self.shape_owners = {}
         row = random.randint(4, 7)
         self.player = Player(IMAGES[row, 1], 
             sequence2animation(IMAGES[20 * row + 1: 20 * row + 4], 0.15), 
@@ -801,9 +1079,6 @@ class GameScene(cocos.scene.Scene):
         ch.begin = lambda a, s, d: False
 
         self.score = 0
-        ch = self.space.add_collision_handler(REWARD_TYPE, PLAYER_TYPE)
-        ch.begin = self.pick_up_reward
-
         ch = self.space.add_collision_handler(TRAP_TYPE, PLAYER_TYPE)
         ch.begin = self.trap_collision
 
@@ -812,13 +1087,16 @@ class GameScene(cocos.scene.Scene):
         self.world = WorldGenerator(self, 3, 3, 
             TILEWIDTH * SCALE, TILEHEIGHT * SCALE)
         self.world.update((0, 0, width, height))
+        self.world.flush()
         chunk = tuple(self.world.chunks)[0]
-        left, bottom, right, top = chunks2bb(chunk, 3, 3, 
+        left, bottom, right, top = rect2bb(chunk, 3, 3, 
             TILEWIDTH * SCALE, TILEHEIGHT * SCALE)
         self.player.position = pymunk.Vec2d((left + right) // 2, top - 1.25 * TILEHEIGHT * SCALE)
-        for shape in self.space.bb_query(self.player.shape.cache_bb(), pymunk.ShapeFilter()):
-            if not isinstance(shape.body, (Ground, Decoration)):
-                self.remove_entity(shape.body)
+        self.player.previous_position = self.player.position
+        bb = self.player.shape.cache_bb()
+        self.remove_entities(*set(self.world.query_items(bb)) | {self.shape_owners[shape] 
+            for shape in self.space.bb_query(bb, pymunk.ShapeFilter())
+            if not isinstance(self.shape_owners[shape], (Player, Ground, Decoration))})
 
         self.ui = cocos.layer.Layer()
         self.heart = cocos.sprite.Sprite(HEARTS[3], 
@@ -834,6 +1112,13 @@ class GameScene(cocos.scene.Scene):
             align="right"
             )
         self.ui.add(self.score_label)
+
+        self.debug_label = cocos.text.Label("", 
+            (TILEWIDTH * SCALE, TILEHEIGHT * SCALE), 
+            font_name="Kenney Mini",
+            font_size=16,
+            )
+        self.ui.add(self.debug_label)
         self.add(self.ui)
 
         self.schedule(self.update)
@@ -855,36 +1140,74 @@ class GameScene(cocos.scene.Scene):
             super().on_exit()
         except AssertionError:
             pass
+        self.world.close()
 
-    def add_entity(self, entity, z=0):
-        # scroller.add(entity.sprites, z)
-        for sprite in entity.sprites:
-            self.scrollable.add(sprite, z)
-        self.space.add(entity, *entity.shapes)
+    def add_entity(self, entity, z=0, layer=None):
+        self.add_entities(entity, z=z, layer=layer)
 
-    def add_entities(self, *entities):
+    def add_entities(self, *entities, z=0, layer=None):
+        layer = self.scrollable if layer is None else layer
+        objects = []
         for entity in entities:
-            self.add_entity(entity)
-
-    def remove_entity(self, entity):
-        try:
-            # scroller.remove(entity.sprites)
-            for sprite in entity.sprites:
-                self.scrollable.remove(sprite)
-        except Exception as e:
-            pass
-        try:
-            self.space.remove(entity, *entity.shapes)
-        except Exception as e:
-            pass
-
-    def remove_entities(self, *entities):
-        for entity in entities:
-            self.remove_entity(entity)
+            if id(entity) in self.registry:
+                raise ValueError(f"{entity!r} is already in the scene")
+            sprites, shapes = tuple(entity.sprites), entity.get_shapes()
+            for sprite in sprites:
+                layer.add(sprite, z)
+            if not entity.physical:
+                body, shapes, entry_objects = entity, (), ()
+            elif self.static_geometry and entity.body_type == pymunk.Body.STATIC:
+                body, entry_objects = self.space.static_body, shapes
+            else:
+                body, entry_objects = entity, (entity, *shapes)
+            for shape in shapes:
+                if shape.body is not body:
+                    shape.body = body
+                self.shape_owners[shape] = entity
+            self.registry[id(entity)] = EntityEntry(entity, layer, sprites, shapes, 
+                entry_objects)
+            objects.extend(entry_objects)
+        self.space.add(*objects)
+
+    def has_entity(self, entity):
+        return id(entity) in self.registry
+
+    def remove_entity(self, entity, sprites=True):
+        self.remove_entities(entity, sprites=sprites)
+
+    def remove_entities(self, *entities, sprites=True):
+        missing = [entity for entity in entities if id(entity) not in self.registry]
+        if missing:
+            raise KeyError(f"{len(missing)} entities are not in the scene: {missing!r}")
+        entries = [self.registry[id(entity)] for entity in entities]
+        layers = collections.defaultdict(list)
+        for entry in entries if sprites else ():
+            layers[entry.layer].extend(entry.sprites)
+        splits = [(layer, *split_children(layer, children)) 
+            for layer, children in layers.items()]
+
+        objects = []
+        for entry in entries:
+            del self.registry[id(entry.entity)]
+            for shape in entry.shapes:
+                del self.shape_owners[shape]
+            objects.extend(entry.objects)
+        for layer, kept, children in splits:
+            detach_children(layer, kept, children)
+        self.space.remove(*objects)
 
     def update(self, dt):
-        self.space.step(STEP)
-        self.player.update(STEP)
+        self.accumulator += dt
+        substeps = 0
+        while self.accumulator >= self.timestep and substeps < self.max_substeps:
+            self.player.step(self.timestep)
+            self.space.step(self.timestep)
+            self.touch_items()
+            self.accumulator -= self.timestep
+            substeps += 1
+        if substeps == self.max_substeps:
+            self.accumulator %= self.timestep
+        self.player.update(dt, self.accumulator / self.timestep)
 
         x = self.player.position.x - width // 2
         y = self.player.position.y - height // 2
@@ -892,6 +1215,11 @@ class GameScene(cocos.scene.Scene):
 
         self.score_label.element.text = f"Score: {self.score}"
 
+        self.debug_label.visible = cocos.director.director.show_FPS
+        if self.debug_label.visible:
+            drawn, total = self.scrollable.get_counts()
+            self.debug_label.element.text = f"Drawn: {drawn}/{total}"
+
         if self.heart.hearts != self.player.hearts:
             index = self.heart.hearts = self.player.hearts
             self.heart.image = HEARTS[index]
@@ -899,6 +1227,7 @@ class GameScene(cocos.scene.Scene):
                 pyglet.clock.schedule_once(self.game_over, 3)
 
     def game_over(self, dt):
+        self.world.discard()
         if not HIGHTSCORES or self.score > min(HIGHTSCORES):
             cocos.director.director.replace(FadeTransition(
                NewHightScoreScene(NewHightScoreMenu("", self.score))))
@@ -915,26 +1244,31 @@ class GameScene(cocos.scene.Scene):
         self.schedule_interval(self.change_style, random.randint(30, 180))
 
     def on_quit(self):
+        self.world.discard()
         cocos.director.director.replace(FadeTransition(MenuScene()))
 
-    def pick_up_reward(self, arbiter, space, data):
-        reward = arbiter.shapes[0].body
+    def touch_items(self):
+        shape = self.player.shape
+        for item in self.world.query_items(shape.cache_bb()):
+            if self.has_entity(item) and shape.shapes_collide(item.shape).points:
+                self.pick_up_reward(item)
+
+    def pick_up_reward(self, reward):
+        reward.collected = True
         self.score += reward.value
         self.remove_entity(reward)
         PICKUP_SOUND.play()
-        return False
 
     def trap_collision(self, arbiter, space, data):
-        player = arbiter.shapes[1].body
+        player = self.shape_owners[arbiter.shapes[1]]
         if player.hearts <= 0:
             return False
         if not arbiter.is_first_contact:
             return True
-        trap = arbiter.shapes[0].body
+        trap = self.shape_owners[arbiter.shapes[0]]
         if isinstance(trap, HiddenTrap):
-            trap.sprite.image = IMAGES[10, 3]
+            trap.reveal()
         player.damage(1)
-        normal = arbiter.normal
         vx, vy = player.velocity
         player.velocity = pymunk.Vec2d(0, 0)
         force = pymunk.Vec2d(math.copysign(200, -vx), 400)
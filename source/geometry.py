@@ -0,0 +1,85 @@
+import math
+import itertools as it
+from array import array
+from collections import namedtuple
+
+
+Rect = namedtuple("Rect", "row column height width")
+
+
+def bb2range(bb, width=16, height=16):
+    left, bottom, right, top = bb
+    return (math.floor(bottom / height), math.ceil(top / height),
+        math.floor(left / width), math.ceil(right / width))
+
+def range2bb(bounds, width=16, height=16):
+    row_start, row_stop, column_start, column_stop = bounds
+    return (column_start * width, row_start * height,
+        column_stop * width, row_stop * height)
+
+def bb2cells(bb, rows=3, columns=3, width=16, height=16):
+    row_start, row_stop, column_start, column_stop = bb2range(bb, width, height)
+    return (-(-row_start // rows), -(-row_stop // rows),
+        -(-column_start // columns), -(-column_stop // columns))
+
+def cells2range(bounds, rows=3, columns=3):
+    row_start, row_stop, column_start, column_stop = bounds
+    return (row_start * rows, row_stop * rows,
+        column_start * columns, column_stop * columns)
+
+
+def rect2range(rect):
+    row, column, height, width = rect
+    return row, row + height, column, column + width
+
+def rect2bb(rect, rows=3, columns=3, width=16, height=16):
+    return range2bb(cells2range(rect2range(rect), rows, columns), width, height)
+
+def rect2cells(rect):
+    row, column, height, width = rect
+    return frozenset(it.product(range(row, row + height), range(column, column + width)))
+
+def iter_cells(rect):
+    row, column, height, width = rect
+    for r in range(row, row + height):
+        for c in range(column, column + width):
+            yield r, c
+
+def cells2rect(cells):
+    cell_rows, cell_columns = zip(*cells)
+    row, column = min(cell_rows), min(cell_columns)
+    return Rect(row, column, max(cell_rows) - row + 1, max(cell_columns) - column + 1)
+
+
+def rect_contains(rect, row, column):
+    top, left, height, width = rect
+    return top <= row < top + height and left <= column < left + width
+
+def rects_overlap(a, b):
+    return (a.row < b.row + b.height and b.row < a.row + a.height
+        and a.column < b.column + b.width and b.column < a.column + a.width)
+
+def rects_containing(row, column, rows=3, columns=3):
+    return [Rect(row - i, column - j, height, width)
+        for width in range(1, columns + 1) for height in range(1, rows + 1)
+        for i in range(height) for j in range(width)]
+
+
+def pack_rects(rects):
+    return array("i", it.chain.from_iterable(rects))
+
+def rects2bbs(packed, rows=3, columns=3, width=16, height=16):
+    xscale, yscale = columns * width, rows * height
+    bbs = array("d", bytes(8 * len(packed)))
+    bbs[0::4] = array("d", (column * xscale for column in packed[1::4]))
+    bbs[1::4] = array("d", (row * yscale for row in packed[0::4]))
+    bbs[2::4] = array("d", ((column + w) * xscale
+        for column, w in zip(packed[1::4], packed[3::4])))
+    bbs[3::4] = array("d", ((row + h) * yscale
+        for row, h in zip(packed[0::4], packed[2::4])))
+    return bbs
+
+def rect_distances(packed, x, y, rows=3, columns=3, width=16, height=16):
+    bbs = rects2bbs(packed, rows, columns, width, height)
+    return [((left + right) / 2 - x) ** 2 + ((bottom + top) / 2 - y) ** 2
+        for left, bottom, right, top in zip(*[iter(bbs)] * 4)]
@@ -0,0 +1,113 @@
+import os
+import tempfile
+import unittest
+
+import wfc
+
+
+SAMPLE = """\
+..##..
+.#..#.
+#.~~.#
+#.~~.#
+.#..#.
+..##..
+"""
+
+
+def make_rules(sample=SAMPLE):
+    lines = sample.splitlines()
+    rules = wfc.Rules()
+    rules.register_neighbors(**wfc.GRID_NEIGHBORS)
+    rules.update_constraints(wfc.text2graph("\n".join(line * 3 for line in lines * 3)))
+    prior = wfc.UnknowState(*wfc.text2graph(sample).values())
+    return rules, prior
+
+
+class ChunkedWaveTest(unittest.TestCase):
+    def setUp(self):
+        self.rules, self.prior = make_rules()
+
+    def solve_block(self, wave, chunks):
+        world = {}
+        for chunk_row, chunk_column in chunks:
+            world.update(wave.get_chunk(chunk_row, chunk_column))
+        return world
+
+    def test_seams_are_consistent(self):
+        size = 5
+        wave = wfc.ChunkedWave(self.rules, self.prior, size, size, seed=7)
+        chunks = [(row, column) for row in range(-2, 2) for column in range(-2, 2)]
+        world = self.solve_block(wave, chunks)
+        self.assertEqual(len(world), len(chunks) * size * size)
+        seams = 0
+        for node, state in world.items():
+            for name, offset in wfc.GRID_NEIGHBORS.items():
+                neighbor = offset(node)
+                if neighbor not in world:
+                    continue
+                if (node[0] // size, node[1] // size) != (neighbor[0] // size, neighbor[1] // size):
+                    seams += 1
+                self.assertIn(world[neighbor], self.rules.constraints[state][name],
+                    (node, name, neighbor))
+        self.assertTrue(seams)
+
+    def test_chunks_do_not_depend_on_order(self):
+        chunks = [(row, column) for row in range(3) for column in range(3)]
+        wave = wfc.ChunkedWave(self.rules, self.prior, 4, 6, seed=3)
+        expected = {chunk: wave.get_chunk(*chunk) for chunk in chunks}
+        wave = wfc.ChunkedWave(self.rules, self.prior, 4, 6, seed=3, cache_size=2)
+        for chunk in reversed(chunks):
+            self.assertEqual(wave.get_chunk(*chunk), expected[chunk])
+
+
+class SavedRulesTest(unittest.TestCase):
+    def setUp(self):
+        rules, self.prior = make_rules()
+        directory = tempfile.TemporaryDirectory(ignore_cleanup_errors=True)
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "rules.wfc")
+        rules.compile().save(path)
+        self.rules = wfc.load_rules(path)
+
+    def test_prefetch_after_solving(self):
+        chunks = [(row, column) for row in range(2) for column in range(2)]
+        wave = wfc.ChunkedWave(self.rules, self.prior, 5, 5, seed=2)
+        wave.get_chunk(2, 2)
+        wave.prefetch(chunks, max_workers=2)
+        expected = wfc.ChunkedWave(self.rules, self.prior, 5, 5, seed=2)
+        for chunk in chunks:
+            self.assertEqual(wave.get_chunk(*chunk), expected.get_chunk(*chunk))
+
+    def test_solve_parallel_after_propagating(self):
+        wave = wfc.DenseWave(self.rules)
+        for row in range(8):
+            for column in range(8):
+                wave[row, column] = self.prior
+        wave.observe((0, 0))
+        wfc.solve_parallel(wave, attempts=2, max_workers=2, seed=5, backtracks=8)
+        self.assertFalse(wave.get_next_nodes())
+        self.assertEqual(len(wave), 64)
+
+
+class SolveParallelTest(unittest.TestCase):
+    def test_reference_wave(self):
+        rules, prior = make_rules()
+        wave = wfc.Wave(rules)
+        for row in range(6):
+            for column in range(6):
+                wave[row, column] = prior
+        wfc.solve_parallel(wave, attempts=2, max_workers=2, seed=1, backtracks=8)
+        self.assertFalse(wave.get_next_nodes())
+
+    def test_unpicklable_wave(self):
+        rules, prior = make_rules()
+        rules.register_neighbors(below=lambda node: (node[0] + 1, node[1]))
+        wave = wfc.Wave(rules)
+        wave[0, 0] = prior
+        with self.assertRaises(TypeError):
+            wfc.solve_parallel(wave, attempts=2, max_workers=2)
+
+
+if __name__ == "__main__":
+    unittest.main()
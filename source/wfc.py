@@ -1,13 +1,29 @@
 
 
-from copy import deepcopy
-from math import inf, log2
-from random import choice, choices
+import os
+import sys
+import mmap
+import pickle
+import struct
+from array import array
+from copy import copy, deepcopy
+from heapq import heappop, heappush
+from math import log2
+from operator import add
+from random import Random, choice, choices
 from functools import partial
-from collections import Counter, defaultdict
+from types import MappingProxyType
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
 from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 
+_MISSING = object()
+
+RULES_MAGIC = b"WFCR"
+RULES_VERSION = 1
+_RULES_HEADER = struct.Struct("<4sHHII")
+
 
 class InconsistentState(Exception):
     pass
@@ -19,6 +35,13 @@ class UnknowState:
         self.weights.update(weights)
         self._on_update()
 
+    @classmethod
+    def from_weights(cls, weights):
+        self = cls.__new__(cls)
+        self.weights = Counter(weights)
+        self._on_update()
+        return self
+
     @property
     def entropy(self):
         return self._entropy
@@ -43,12 +66,175 @@ class UnknowState:
                 del self.weights[state]
         self._on_update()
 
-    def observe(self):
+    def restrict(self, states):
+        removed = [state for state in self.weights if state not in states]
+        for state in removed:
+            del self.weights[state]
+        if removed:
+            self._on_update()
+        return bool(removed)
+
+    def observe(self, rng=None):
         states, weights = zip(*self.weights.items())
-        return choices(states, weights)[0]
+        if rng is None:
+            return choices(states, weights)[0]
+        return rng.choices(states, weights)[0]
 
     def copy(self):
-        return deepcopy(self)
+        state = UnknowState.__new__(type(self))
+        state.weights = self.weights.copy()
+        state._entropy = self._entropy
+        return state
+
+
+class Offset:
+    def __init__(self, *delta):
+        self.delta = delta
+
+    def __call__(self, node):
+        return tuple(map(add, node, self.delta))
+
+
+GRID_NEIGHBORS = {
+    "up": Offset(-1, 0),
+    "down": Offset(1, 0),
+    "left": Offset(0, -1),
+    "right": Offset(0, 1),
+}
+
+
+def _encode_state(state, buffer):
+    if isinstance(state, str):
+        data = state.encode()
+        buffer += b"s" + struct.pack("<I", len(data)) + data
+    elif isinstance(state, int):
+        buffer += b"i" + struct.pack("<q", state)
+    elif isinstance(state, tuple):
+        buffer += b"t" + struct.pack("<I", len(state))
+        for item in state:
+            _encode_state(item, buffer)
+    else:
+        raise TypeError(f"cannot serialize state {state!r}")
+
+
+def _decode_state(buffer, offset):
+    tag = buffer[offset]
+    offset += 1
+    if tag == ord("s"):
+        length, = struct.unpack_from("<I", buffer, offset)
+        offset += 4
+        return bytes(buffer[offset: offset + length]).decode(), offset + length
+    if tag == ord("i"):
+        return struct.unpack_from("<q", buffer, offset)[0], offset + 8
+    if tag == ord("t"):
+        length, = struct.unpack_from("<I", buffer, offset)
+        offset += 4
+        items = []
+        for _ in range(length):
+            item, offset = _decode_state(buffer, offset)
+            items.append(item)
+        return tuple(items), offset
+    raise ValueError(f"unknown state tag {tag!r}")
+
+
+class CompiledRules(namedtuple("CompiledRules", 
+    "states ids directions offsets callbacks counts supports source", 
+    defaults=(None,))):
+    __slots__ = ()
+
+    def __reduce__(self):
+        if self.source is not None:
+            return load_rules, (self.source,)
+        return _make_rules, (self.states, self.directions, self.offsets, 
+            self.callbacks, tuple(array("I", matrix) for matrix in self.counts), 
+            self.supports)
+
+    def get_neighbor(self, direction, node):
+        offset = self.offsets[direction]
+        if offset is None:
+            return self.callbacks[direction](node)
+        return tuple(map(add, node, offset))
+
+    def get_counts(self, direction, state_id):
+        size = len(self.states)
+        return self.counts[direction][state_id * size: (state_id + 1) * size]
+
+    def save(self, path):
+        size = len(self.states)
+        header = bytearray(_RULES_HEADER.pack(RULES_MAGIC, RULES_VERSION, 0, 
+            size, len(self.directions)))
+        for state in self.states:
+            _encode_state(state, header)
+        for name, offset in zip(self.directions, self.offsets):
+            if offset is None:
+                raise ValueError(f"direction {name!r} has no grid offset")
+            data = name.encode()
+            header += struct.pack("<IB", len(data), len(offset)) + data
+            header += struct.pack(f"<{len(offset)}i", *offset)
+        header += bytes(-len(header) % 8)
+        width = (size + 7) // 8
+        with open(path, "wb") as file:
+            file.write(header)
+            for matrix in self.counts:
+                matrix = array("I", matrix)
+                if sys.byteorder != "little":
+                    matrix.byteswap()
+                file.write(matrix)
+            for masks in self.supports:
+                file.write(b"".join(mask.to_bytes(width, "little") for mask in masks))
+
+
+def _make_rules(states, directions, offsets, callbacks, counts, supports, 
+        source=None):
+    ids = MappingProxyType({state: i for i, state in enumerate(states)})
+    counts = tuple(memoryview(matrix).toreadonly() for matrix in counts)
+    return CompiledRules(tuple(states), ids, tuple(directions), tuple(offsets), 
+        tuple(callbacks), counts, tuple(supports), source)
+
+
+def load_rules(path):
+    path = os.fspath(path)
+    with open(path, "rb") as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(buffer)
+    magic, version, _, size, count = _RULES_HEADER.unpack_from(view)
+    if magic != RULES_MAGIC:
+        raise ValueError(f"{path!r} is not a rules file")
+    if version != RULES_VERSION:
+        raise ValueError(f"unsupported rules version {version}")
+    offset = _RULES_HEADER.size
+    states = []
+    for _ in range(size):
+        state, offset = _decode_state(view, offset)
+        states.append(state)
+    directions = []
+    offsets = []
+    for _ in range(count):
+        length, dimensions = struct.unpack_from("<IB", view, offset)
+        offset += 5
+        directions.append(bytes(view[offset: offset + length]).decode())
+        offset += length
+        offsets.append(struct.unpack_from(f"<{dimensions}i", view, offset))
+        offset += 4 * dimensions
+    offset += -offset % 8
+    counts = []
+    for _ in range(count):
+        matrix = view[offset: offset + 4 * size * size]
+        if sys.byteorder == "little":
+            matrix = matrix.cast("I")
+        else:
+            matrix = array("I", matrix)
+            matrix.byteswap()
+        counts.append(matrix)
+        offset += 4 * size * size
+    width = (size + 7) // 8
+    supports = []
+    for _ in range(count):
+        supports.append(tuple(int.from_bytes(view[start: start + width], "little") 
+            for start in range(offset, offset + width * size, width)))
+        offset += width * size
+    return _make_rules(states, directions, offsets, (None,) * count, counts, 
+        supports, path)
 
 
 class Rules:
@@ -65,6 +251,20 @@ class Rules:
             neighbor = self.get_neighbor(name, node)
             yield neighbor, constraint
 
+    def get_support(self, node, states):
+        support = {}
+        unconstrained = set()
+        for state in states:
+            constraints = self.constraints.get(state, {})
+            for name in self.neighbors:
+                if name in constraints:
+                    support.setdefault(name, set()).update(constraints[name])
+                else:
+                    unconstrained.add(name)
+        for name, allowed in support.items():
+            if name not in unconstrained:
+                yield self.get_neighbor(name, node), allowed
+
     def update_constraints(self, graph):
         for node, state in graph.items():
             for name, callback in self.neighbors.items():
@@ -88,25 +288,143 @@ class Rules:
             self.register_neighbors(**{name: callback})
         return callback
 
+    def compile(self, states=()):
+        ids = {}
+        for state in states:
+            ids.setdefault(state, len(ids))
+        for state, constraints in self.constraints.items():
+            ids.setdefault(state, len(ids))
+            for constraint in constraints.values():
+                for neighbor_state in constraint:
+                    ids.setdefault(neighbor_state, len(ids))
+        size = len(ids)
+        full = (1 << size) - 1
+        directions = tuple(self.neighbors)
+        offsets = []
+        callbacks = []
+        counts = []
+        supports = []
+        for name in directions:
+            callback = self.neighbors[name]
+            if isinstance(callback, Offset):
+                offsets.append(callback.delta)
+                callbacks.append(None)
+            else:
+                offsets.append(None)
+                callbacks.append(callback)
+            matrix = array("I", bytes(4 * size * size))
+            masks = []
+            for state, state_id in ids.items():
+                start = state_id * size
+                constraint = self.constraints.get(state, {}).get(name)
+                if constraint is None:
+                    matrix[start: start + size] = array("I", [1] * size)
+                    masks.append(full)
+                    continue
+                mask = 0
+                for neighbor_state, count in constraint.items():
+                    neighbor_id = ids[neighbor_state]
+                    matrix[start + neighbor_id] = count
+                    mask |= 1 << neighbor_id
+                masks.append(mask)
+            counts.append(matrix)
+            supports.append(tuple(masks))
+        return _make_rules(ids, directions, offsets, callbacks, counts, supports)
+
     def copy(self):
         return deepcopy(self)
 
 
+class EntropyIndex:
+    def __init__(self):
+        self.heap = []
+        self.buckets = {}
+        self.entries = {}
+        self.positions = {}
+
+    def __contains__(self, node):
+        return node in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def update(self, node, entropy):
+        old_entropy = self.entries.get(node)
+        if old_entropy is not None:
+            if old_entropy == entropy:
+                return
+            self._remove(node, old_entropy)
+        bucket = self.buckets.get(entropy)
+        if bucket is None:
+            bucket = self.buckets[entropy] = []
+            heappush(self.heap, entropy)
+        self.entries[node] = entropy
+        self.positions[node] = len(bucket)
+        bucket.append(node)
+
+    def discard(self, node):
+        entropy = self.entries.pop(node, None)
+        if entropy is not None:
+            self._remove(node, entropy)
+
+    def _remove(self, node, entropy):
+        bucket = self.buckets[entropy]
+        index = self.positions.pop(node)
+        last = bucket.pop()
+        if index < len(bucket):
+            bucket[index] = last
+            self.positions[last] = index
+        elif not bucket:
+            del self.buckets[entropy]
+
+    def min_bucket(self):
+        heap = self.heap
+        while heap:
+            bucket = self.buckets.get(heap[0])
+            if bucket:
+                return bucket
+            heappop(heap)
+        return []
+
+    def copy(self):
+        index = copy(self)
+        index.heap = list(self.heap)
+        index.buckets = {entropy: list(bucket) 
+            for entropy, bucket in self.buckets.items()}
+        index.entries = dict(self.entries)
+        index.positions = dict(self.positions)
+        return index
+
+
 class Wave(MutableMapping):
-    def __init__(self, rules=None):
+    def __init__(self, rules=None, rng=None):
         if rules is None:
             rules = Rules()
         self.rules = rules
+        self.rng = rng
         self.nodes = {}
+        self.index = EntropyIndex()
+        self.stats = Counter()
+        self.trail = []
+        self.checkpoints = []
+        self.floor = None
+        self.floor_depth = 0
 
     def __getitem__(self, node):
         return self.nodes[node]
 
     def __setitem__(self, node, state):
+        self._record(node)
         self.nodes[node] = state
+        if isinstance(state, UnknowState):
+            self.index.update(node, state.entropy)
+        else:
+            self.index.discard(node)
 
     def __delitem__(self, node):
+        self._record(node)
         del self.nodes[node]
+        self.index.discard(node)
 
     def __iter__(self):
         return iter(self.nodes)
@@ -114,45 +432,683 @@ class Wave(MutableMapping):
     def __len__(self):
         return len(self.nodes)
 
+    def _save(self, node):
+        state = self.nodes.get(node, _MISSING)
+        if isinstance(state, UnknowState):
+            return state.copy()
+        return state
+
+    def _restore(self, node, saved):
+        if saved is _MISSING:
+            self.nodes.pop(node, None)
+            self.index.discard(node)
+        else:
+            self.nodes[node] = saved
+            if isinstance(saved, UnknowState):
+                self.index.update(node, saved.entropy)
+            else:
+                self.index.discard(node)
+
+    def _iter_decided(self):
+        for node, state in tuple(self.nodes.items()):
+            if not isinstance(state, UnknowState):
+                yield node, state
+
+    def _record(self, node):
+        if self.checkpoints:
+            self.trail.append((node, self._save(node)))
+
+    def checkpoint(self):
+        self.checkpoints.append(len(self.trail))
+        return len(self.checkpoints)
+
+    def rollback(self):
+        mark = self.checkpoints.pop()
+        trail = self.trail
+        while len(trail) > mark:
+            self._restore(*trail.pop())
+        if self.floor is not None and len(self.checkpoints) < self.floor_depth:
+            for node, saved in self.floor.items():
+                self._restore(node, saved)
+            self.floor = None
+
+    def commit(self):
+        mark = self.checkpoints.pop()
+        if self.floor is not None and len(self.checkpoints) < self.floor_depth:
+            self.trail[mark:mark] = self.floor.items()
+            self.floor = None
+        if not self.checkpoints:
+            self.trail.clear()
+
+    def squash(self, depth):
+        owner = self.checkpoints[depth - 2]
+        del self.checkpoints[depth - 1]
+        if depth - 1 < len(self.checkpoints):
+            stop = self.checkpoints[depth - 1]
+        else:
+            stop = len(self.trail)
+        if self.floor is None:
+            self.floor = {}
+            self.floor_depth = depth - 1
+        floor = self.floor
+        for node, saved in self.trail[owner: stop]:
+            floor.setdefault(node, saved)
+        del self.trail[owner: stop]
+        shift = stop - owner
+        for i in range(depth - 1, len(self.checkpoints)):
+            self.checkpoints[i] -= shift
+
     def get_next_nodes(self):
-        min_entropy = inf
-        min_nodes = []
-        for node, state in self.nodes.items():
-            if isinstance(state, UnknowState):
-                entropy = state.entropy
-                if entropy <= min_entropy:
-                    if entropy < min_entropy:
-                        min_entropy = entropy
-                        min_nodes.clear()
-                    min_nodes.append(node)
-        return min_nodes
+        return list(self.index.min_bucket())
+
+    def _choice(self, nodes):
+        if self.rng is None:
+            return choice(nodes)
+        return self.rng.choice(nodes)
+
+    def _propagate(self, queue):
+        while queue:
+            node = queue.popleft()
+            self.stats["propagations"] += 1
+            states = self.nodes[node].weights
+            for neighbor, allowed in self.rules.get_support(node, states):
+                if neighbor not in self.nodes:
+                    continue
+                neighbor_state = self.nodes[neighbor]
+                if isinstance(neighbor_state, UnknowState):
+                    if not neighbor_state.weights.keys() <= allowed:
+                        self._record(neighbor)
+                        neighbor_state.restrict(allowed)
+                        self.index.update(neighbor, neighbor_state.entropy)
+                        queue.append(neighbor)
+                elif neighbor_state not in allowed:
+                    raise InconsistentState()
 
     def propagate(self, node, state):
-        for neighbor, constraint in self.rules.get_constraints(node, state):
-            neighbor_state = self.nodes.get(neighbor)
-            if isinstance(neighbor_state, UnknowState):
-                neighbor_state.constrain(constraint)
-            elif neighbor_state not in constraint:
-                raise InconsistentState
+        try:
+            queue = deque()
+            for neighbor, constraint in self.rules.get_constraints(node, state):
+                if neighbor not in self.nodes:
+                    continue
+                neighbor_state = self.nodes[neighbor]
+                if isinstance(neighbor_state, UnknowState):
+                    self._record(neighbor)
+                    size = len(neighbor_state.weights)
+                    neighbor_state.constrain(constraint)
+                    self.index.update(neighbor, neighbor_state.entropy)
+                    if len(neighbor_state.weights) < size:
+                        queue.append(neighbor)
+                elif neighbor_state not in constraint:
+                    raise InconsistentState()
+            self._propagate(queue)
+        except InconsistentState:
+            self.stats["contradictions"] += 1
+            raise
+
+    def exclude(self, node, state):
+        try:
+            current = self.nodes[node]
+            if not isinstance(current, UnknowState):
+                if current == state:
+                    raise InconsistentState()
+                return
+            if state in current.weights:
+                self._record(node)
+                current.restrict(current.weights.keys() - {state})
+                self.index.update(node, current.entropy)
+                self._propagate(deque([node]))
+        except InconsistentState:
+            self.stats["contradictions"] += 1
+            raise
 
     def observe(self, node):
         state = self.nodes[node]
         if isinstance(state, UnknowState):
-            state = state.observe()
-            self.nodes[node] = state
+            self.stats["observations"] += 1
+            state = state.observe(self.rng)
+            self[node] = state
             self.propagate(node, state)
         return state
 
     def collapse(self):
-        nodes = self.get_next_nodes()
+        nodes = self.index.min_bucket()
         while nodes:
-            node = choice(nodes)
+            node = self._choice(nodes)
             state = self.observe(node)
             yield node, state
-            nodes = self.get_next_nodes()
+            nodes = self.index.min_bucket()
+
+    def _search(self, backtracks):
+        decisions = deque()
+        nodes = self.index.min_bucket()
+        while nodes:
+            node = self._choice(nodes)
+            self.checkpoint()
+            try:
+                decisions.append((node, self.observe(node)))
+            except InconsistentState:
+                state = self[node]
+                self.rollback()
+                while True:
+                    try:
+                        self.exclude(node, state)
+                        break
+                    except InconsistentState:
+                        if not decisions or backtracks <= 0:
+                            raise
+                        backtracks -= 1
+                        self.stats["backtracks"] += 1
+                        self.rollback()
+                        node, state = decisions.pop()
+            while len(decisions) > backtracks:
+                self.squash(len(self.checkpoints) - len(decisions) + 1)
+                decisions.popleft()
+            nodes = self.index.min_bucket()
+        for _ in decisions:
+            self.commit()
+
+    def solve(self, attempts=1, backtracks=10):
+        for attempt in range(attempts):
+            depth = self.checkpoint()
+            try:
+                for node, state in self._iter_decided():
+                    self.propagate(node, state)
+                self._search(backtracks)
+                self.commit()
+                return self
+            except InconsistentState:
+                while len(self.checkpoints) >= depth:
+                    self.rollback()
+                if attempt + 1 >= attempts:
+                    raise
+                self.stats["restarts"] += 1
 
     def copy(self):
-        return deepcopy(self)
+        wave = Wave(self.rules, self.rng)
+        for node, state in self.nodes.items():
+            if isinstance(state, UnknowState):
+                state = state.copy()
+            wave[node] = state
+        return wave
+
+
+class DenseWave(Wave):
+    def __init__(self, rules=None, states=(), rng=None):
+        if rules is None:
+            rules = Rules()
+        if isinstance(rules, Rules):
+            rules = rules.compile(states)
+        self.rules = rules
+        self.rng = rng
+        self.states = rules.states
+        self.rows = {}
+        self.row_nodes = []
+        self.values = []
+        self.masks = []
+        self.weights = []
+        self.links = None
+        self.tables = {}
+        self.supports = {}
+        self.index = EntropyIndex()
+        self.stats = Counter()
+        self.trail = []
+        self.checkpoints = []
+        self.floor = None
+        self.floor_depth = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["tables"] = {}
+        state["supports"] = {}
+        return state
+
+    def _get_table(self, state_id):
+        table = self.tables.get(state_id)
+        if table is None:
+            rules = self.rules
+            table = self.tables[state_id] = tuple((direction, 
+                rules.supports[direction][state_id], 
+                rules.get_counts(direction, state_id)) 
+                for direction in range(len(rules.directions)))
+        return table
+
+    def _get_support(self, mask):
+        support = self.supports.get(mask)
+        if support is None:
+            unions = [0] * len(self.rules.directions)
+            bits = mask
+            while bits:
+                low = bits & -bits
+                bits ^= low
+                for direction, allowed, _ in self._get_table(low.bit_length() - 1):
+                    unions[direction] |= allowed
+            support = self.supports[mask] = tuple(enumerate(unions))
+        return support
+
+    def _get_links(self, row):
+        if self.links is None:
+            self.links = [None] * len(self.row_nodes)
+        links = self.links[row]
+        if links is None:
+            node = self.row_nodes[row]
+            get_neighbor = self.rules.get_neighbor
+            links = self.links[row] = tuple(self.rows.get(get_neighbor(direction, node)) 
+                for direction in range(len(self.rules.directions)))
+        return links
+
+    def _add_row(self, node):
+        self.links = None
+        row = self.rows[node] = len(self.row_nodes)
+        self.row_nodes.append(node)
+        self.values.append(-1)
+        self.masks.append(0)
+        self.weights.append(None)
+        return row
+
+    def _remove_row(self, node):
+        self.links = None
+        row = self.rows.pop(node)
+        self.index.discard(node)
+        last = len(self.row_nodes) - 1
+        if row != last:
+            moved = self.row_nodes[row] = self.row_nodes[last]
+            self.rows[moved] = row
+            for column in (self.values, self.masks, self.weights):
+                column[row] = column[last]
+        for column in (self.row_nodes, self.values, self.masks, self.weights):
+            column.pop()
+
+    def _set_row(self, row, weights, mask):
+        total = sum(weights)
+        if total <= 0:
+            raise InconsistentState()
+        weights = [w / total for w in weights]
+        self.values[row] = -1
+        self.masks[row] = mask
+        self.weights[row] = weights
+        if mask & (mask - 1):
+            entropy = -sum([w * log2(w) for w in weights if w])
+        else:
+            entropy = 0.0
+        self.index.update(self.row_nodes[row], entropy)
+
+    def _set_value(self, row, state_id):
+        self.values[row] = state_id
+        self.masks[row] = 1 << state_id
+        self.weights[row] = None
+        self.index.discard(self.row_nodes[row])
+
+    def _save(self, node):
+        row = self.rows.get(node)
+        if row is None:
+            return _MISSING
+        return (self.values[row], self.masks[row], 
+            self.weights[row], self.index.entries.get(node))
+
+    def _restore(self, node, saved):
+        if saved is _MISSING:
+            if node in self.rows:
+                self._remove_row(node)
+            return
+        row = self.rows.get(node)
+        if row is None:
+            row = self._add_row(node)
+        value, mask, weights, entropy = saved
+        self.values[row] = value
+        self.masks[row] = mask
+        self.weights[row] = weights
+        if entropy is None:
+            self.index.discard(node)
+        else:
+            self.index.update(node, entropy)
+
+    def _iter_decided(self):
+        for node, row in tuple(self.rows.items()):
+            value = self.values[row]
+            if value >= 0:
+                yield node, self.states[value]
+
+    def __getitem__(self, node):
+        row = self.rows[node]
+        value = self.values[row]
+        if value >= 0:
+            return self.states[value]
+        return UnknowState.from_weights({self.states[i]: w 
+            for i, w in enumerate(self.weights[row]) if w})
+
+    def __setitem__(self, node, state):
+        self._record(node)
+        row = self.rows.get(node)
+        if row is None:
+            row = self._add_row(node)
+        if isinstance(state, UnknowState):
+            weights = [0.0] * len(self.states)
+            mask = 0
+            ids = self.rules.ids
+            for s, weight in state.weights.items():
+                index = ids[s]
+                weights[index] = weight
+                mask |= 1 << index
+            self._set_row(row, weights, mask)
+        else:
+            self._set_value(row, self.rules.ids[state])
+
+    def __delitem__(self, node):
+        self._record(node)
+        self._remove_row(node)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _propagate(self, queue):
+        while queue:
+            row = queue.popleft()
+            self.stats["propagations"] += 1
+            links = self._get_links(row)
+            for direction, support in self._get_support(self.masks[row]):
+                row = links[direction]
+                if row is None:
+                    continue
+                mask = self.masks[row] & support
+                if not mask:
+                    raise InconsistentState()
+                if mask != self.masks[row] and self.values[row] < 0:
+                    self._record(self.row_nodes[row])
+                    self._set_row(row, [w if mask >> i & 1 else 0.0 
+                        for i, w in enumerate(self.weights[row])], mask)
+                    queue.append(row)
+
+    def propagate(self, node, state):
+        try:
+            queue = deque()
+            links = self._get_links(self.rows[node])
+            for direction, support, counts in self._get_table(self.rules.ids[state]):
+                row = links[direction]
+                if row is None:
+                    continue
+                mask = self.masks[row] & support
+                if not mask:
+                    raise InconsistentState()
+                if self.values[row] < 0:
+                    if mask != self.masks[row]:
+                        queue.append(row)
+                    self._record(self.row_nodes[row])
+                    self._set_row(row, [w * c for w, c 
+                        in zip(self.weights[row], counts)], mask)
+            self._propagate(queue)
+        except InconsistentState:
+            self.stats["contradictions"] += 1
+            raise
+
+    def exclude(self, node, state):
+        try:
+            row = self.rows[node]
+            state_id = self.rules.ids[state]
+            if self.values[row] >= 0:
+                if self.values[row] == state_id:
+                    raise InconsistentState()
+                return
+            mask = self.masks[row] & ~(1 << state_id)
+            if mask != self.masks[row]:
+                if not mask:
+                    raise InconsistentState()
+                self._record(node)
+                weights = list(self.weights[row])
+                weights[state_id] = 0.0
+                self._set_row(row, weights, mask)
+                self._propagate(deque([row]))
+        except InconsistentState:
+            self.stats["contradictions"] += 1
+            raise
+
+    def observe(self, node):
+        row = self.rows[node]
+        value = self.values[row]
+        if value < 0:
+            self.stats["observations"] += 1
+            if self.rng is None:
+                value = choices(range(len(self.states)), self.weights[row])[0]
+            else:
+                value = self.rng.choices(range(len(self.states)), self.weights[row])[0]
+            self._record(node)
+            self._set_value(row, value)
+            self.propagate(node, self.states[value])
+        return self.states[value]
+
+    def copy(self):
+        wave = copy(self)
+        wave.rows = dict(self.rows)
+        wave.row_nodes = list(self.row_nodes)
+        wave.values = list(self.values)
+        wave.masks = list(self.masks)
+        wave.weights = list(self.weights)
+        wave.links = None
+        wave.tables = dict(self.tables)
+        wave.supports = dict(self.supports)
+        wave.index = self.index.copy()
+        wave.stats = Counter()
+        wave.trail = []
+        wave.checkpoints = []
+        wave.floor = None
+        return wave
+
+
+def solve_region(template, prior, seed, key, nodes, fixed, attempts=1, backtracks=0):
+    wave = template.copy()
+    wave.rng = Random(":".join(map(str, (seed, *key))))
+    for node in nodes:
+        wave[node] = fixed.get(node, prior)
+    wave.solve(attempts, backtracks)
+    return dict(wave)
+
+
+def _solve_attempt(data, seed, backtracks):
+    wave = pickle.loads(data)
+    wave.rng = Random(seed)
+    try:
+        wave.solve(1, backtracks)
+    except InconsistentState:
+        return None, wave.stats
+    return dict(wave), wave.stats
+
+
+def _to_dense(wave):
+    if isinstance(wave, DenseWave):
+        return wave
+    states = {}
+    for state in wave.values():
+        if isinstance(state, UnknowState):
+            states.update(dict.fromkeys(state.weights))
+        else:
+            states[state] = None
+    dense = DenseWave(wave.rules, states, wave.rng)
+    dense.update(wave)
+    return dense
+
+
+def solve_parallel(wave, attempts=8, max_workers=None, seed=None, backtracks=0):
+    if seed is None:
+        seed = Random().getrandbits(64)
+    try:
+        data = pickle.dumps(_to_dense(wave))
+    except (pickle.PicklingError, TypeError, AttributeError) as error:
+        raise TypeError(f"cannot send {type(wave).__name__} to worker processes: "
+            f"{error}") from error
+    executor = ProcessPoolExecutor(max_workers)
+    wait = True
+    try:
+        futures = [executor.submit(_solve_attempt, data, f"{seed}:{attempt}", backtracks) 
+            for attempt in range(attempts)]
+        for future in as_completed(futures):
+            graph, stats = future.result()
+            wave.stats.update(stats)
+            if graph is not None:
+                wave.update(graph)
+                wait = False
+                return wave
+            wave.stats["restarts"] += 1
+    finally:
+        executor.shutdown(wait=wait, cancel_futures=True)
+    raise InconsistentState()
+
+
+class ChunkedWave:
+    def __init__(self, rules, prior, chunk_rows=16, chunk_columns=16, 
+        seed=0, cache_size=256, attempts=8, backtracks=64):
+        self.template = DenseWave(rules)
+        self.prior = prior
+        self.chunk_rows = chunk_rows
+        self.chunk_columns = chunk_columns
+        self.seed = seed
+        self.cache_size = cache_size
+        self.attempts = attempts
+        self.backtracks = backtracks
+        self.cache = OrderedDict()
+
+    def __getitem__(self, node):
+        row, column = node
+        chunk = self.get_chunk(row // self.chunk_rows, column // self.chunk_columns)
+        return chunk[node]
+
+    def _store(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return value
+
+    def _cached(self, key, solve):
+        value = self.cache.get(key)
+        if value is None:
+            return self._store(key, solve(*key[1:]))
+        self.cache.move_to_end(key)
+        return value
+
+    def _solve(self, key, nodes, fixed):
+        return solve_region(self.template, self.prior, self.seed, 
+            key, nodes, fixed, self.attempts, self.backtracks)
+
+    def _get_box(self, top, left, rows, columns):
+        return [(top + i, left + j) for i in range(rows) for j in range(columns)]
+
+    def _get_neighbors(self, chunk_row, chunk_column):
+        neighbors = []
+        if chunk_row % 2:
+            neighbors += [(chunk_row - 1, chunk_column), (chunk_row + 1, chunk_column)]
+        if chunk_column % 2:
+            neighbors += [(chunk_row, chunk_column - 1), (chunk_row, chunk_column + 1)]
+        return neighbors
+
+    def _get_frame(self, chunk_row, chunk_column):
+        nodes = self._get_box(chunk_row * self.chunk_rows - 1, 
+            chunk_column * self.chunk_columns - 1, 
+            self.chunk_rows + 2, self.chunk_columns + 2)
+        fixed = {}
+        for neighbor in self._get_neighbors(chunk_row, chunk_column):
+            fixed.update(self.get_chunk(*neighbor))
+        return nodes, fixed
+
+    def _crop(self, chunk_row, chunk_column, graph):
+        nodes = self._get_box(chunk_row * self.chunk_rows, 
+            chunk_column * self.chunk_columns, self.chunk_rows, self.chunk_columns)
+        return {node: graph[node] for node in nodes}
+
+    def _solve_chunk(self, chunk_row, chunk_column):
+        graph = self._solve(("chunk", chunk_row, chunk_column), 
+            *self._get_frame(chunk_row, chunk_column))
+        return self._crop(chunk_row, chunk_column, graph)
+
+    def get_chunk(self, chunk_row, chunk_column):
+        return self._cached(("chunk", chunk_row, chunk_column), self._solve_chunk)
+
+    def prefetch(self, chunks, max_workers=None):
+        levels = [set(), set(), set()]
+        pending = list(chunks)
+        while pending:
+            chunk_row, chunk_column = chunk = pending.pop()
+            level = levels[chunk_row % 2 + chunk_column % 2]
+            if chunk in level or ("chunk", *chunk) in self.cache:
+                continue
+            level.add(chunk)
+            pending.extend(self._get_neighbors(*chunk))
+        with ProcessPoolExecutor(max_workers) as executor:
+            for level in levels:
+                futures = {}
+                for chunk in level:
+                    key = ("chunk", *chunk)
+                    nodes, fixed = self._get_frame(*chunk)
+                    future = executor.submit(solve_region, self.template, self.prior, 
+                        self.seed, key, nodes, fixed, self.attempts, self.backtracks)
+                    futures[future] = key
+                for future in as_completed(futures):
+                    key = futures[future]
+                    self._store(key, self._crop(*key[1:], future.result()))
+
+
+class OverlappingPatterns:
+    def __init__(self, size=2):
+        self.size = size
+        self.patterns = []
+        self.ids = {}
+        self.frequencies = array("I")
+        self.counts = {"right": [], "down": []}
+
+    def _get_id(self, pattern):
+        pattern_id = self.ids.get(pattern)
+        if pattern_id is None:
+            pattern_id = self.ids[pattern] = len(self.patterns)
+            self.patterns.append(pattern)
+            self.frequencies.append(0)
+            for rows in self.counts.values():
+                rows.append(array("I"))
+        self.frequencies[pattern_id] += 1
+        return pattern_id
+
+    def _count(self, name, pattern_id, neighbor_id):
+        row = self.counts[name][pattern_id]
+        if neighbor_id >= len(row):
+            row.frombytes(bytes(row.itemsize * (neighbor_id + 1 - len(row))))
+        row[neighbor_id] += 1
+
+    def update(self, lines):
+        size = self.size
+        window = deque(maxlen=size)
+        previous = ()
+        for line in lines:
+            window.append(line.rstrip("\r\n"))
+            if len(window) < size:
+                continue
+            width = min(map(len, window)) - size + 1
+            current = [self._get_id(tuple(text[column: column + size] 
+                for text in window)) for column in range(width)]
+            for pattern_id, neighbor_id in zip(current, current[1:]):
+                self._count("right", pattern_id, neighbor_id)
+            for pattern_id, neighbor_id in zip(previous, current):
+                self._count("down", pattern_id, neighbor_id)
+            previous = current
+
+    def prior(self):
+        return UnknowState.from_weights(dict(zip(self.patterns, self.frequencies)))
+
+    def to_rules(self):
+        rules = Rules()
+        rules.register_neighbors(**GRID_NEIGHBORS)
+        patterns = self.patterns
+        for name, inverse in (("right", "left"), ("down", "up")):
+            for pattern_id, row in enumerate(self.counts[name]):
+                pattern = patterns[pattern_id]
+                for neighbor_id, count in enumerate(row):
+                    if count:
+                        neighbor = patterns[neighbor_id]
+                        rules.constraints[pattern][name][neighbor] += count
+                        rules.constraints[neighbor][inverse][pattern] += count
+        return rules
+
+    def decode(self, graph):
+        return {node: pattern[0][0] for node, pattern in graph.items()}
 
 
 def text2graph(text):
@@ -0,0 +1,191 @@
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+from collections import Counter
+from statistics import quantiles
+
+import wfc
+
+
+SYMBOLS = ".#~+=*%@&$abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+MODES = {
+    "wave": wfc.Wave,
+    "dense": wfc.DenseWave,
+}
+
+
+def make_sample(size, states, seed):
+    rng = random.Random(f"sample:{size}:{states}:{seed}")
+    alphabet = SYMBOLS[:states]
+    rows = [[alphabet[0]] * size for _ in range(size)]
+    for _ in range(size * size // 8):
+        char = rng.choice(alphabet[1:] or alphabet)
+        top, left = rng.randrange(size), rng.randrange(size)
+        height, width = rng.randint(1, 4), rng.randint(1, 4)
+        for row in range(top, min(top + height, size)):
+            for column in range(left, min(left + width, size)):
+                rows[row][column] = char
+    return "\n".join(map("".join, rows))
+
+
+def train(sample):
+    rules = wfc.Rules()
+    rules.register_neighbors(**wfc.GRID_NEIGHBORS)
+    graph = wfc.text2graph(sample)
+    rules.update_constraints(graph)
+    return rules, graph
+
+
+def percentile(times, p):
+    if len(times) < 2:
+        return times[0] if times else 0.0
+    return quantiles(times, n=100, method="inclusive")[p - 1]
+
+
+def bench_training(sample):
+    start = time.perf_counter()
+    rules, graph = train(sample)
+    elapsed = time.perf_counter() - start
+    return {"nodes": len(graph), "seconds": elapsed,
+        "nodes_per_second": len(graph) / elapsed}
+
+
+def run_solve(cls, rules, prior, size, seed, attempts, backtracks):
+    wave = cls(rules, rng=random.Random(f"solve:{seed}"))
+    for row in range(size):
+        for column in range(size):
+            wave[row, column] = prior.copy()
+    failed = False
+    start = time.perf_counter()
+    try:
+        wave.solve(attempts, backtracks)
+    except wfc.InconsistentState:
+        failed = True
+    return wave, time.perf_counter() - start, failed
+
+
+def bench_solve(cls, rules, prior, size, seed, attempts=8, backtracks=64, 
+    memory=True, generations=3):
+    stats = Counter()
+    times = []
+    successes = 0
+    for generation in range(generations):
+        wave, elapsed, failed = run_solve(cls, rules, prior, size, 
+            f"{seed}:{generation}", attempts, backtracks)
+        stats.update(wave.stats)
+        times.append(elapsed)
+        successes += not failed
+    elapsed = sum(times)
+    observations = stats["observations"] or 1
+    per_success = successes or 1
+    result = {
+        "nodes": size * size,
+        "generations": generations,
+        "successes": successes,
+        "seconds": elapsed,
+        "nodes_per_second": successes * size * size / elapsed,
+        "propagations_per_second": stats["propagations"] / elapsed,
+        "p50_generation_ms": percentile(times, 50) * 1e3,
+        "p99_generation_ms": percentile(times, 99) * 1e3,
+        "contradiction_rate": stats["contradictions"] / observations,
+        "restarts_per_success": stats["restarts"] / per_success,
+        "backtracks_per_success": stats["backtracks"] / per_success,
+    }
+    if memory:
+        tracemalloc.start()
+        run_solve(cls, rules, prior, size, f"{seed}:0", attempts, backtracks)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_bytes"] = peak
+        result["bytes_per_node"] = peak / (size * size)
+    return result
+
+
+def run(sizes, vocabularies, modes, seed, attempts=8, backtracks=64, memory=True, 
+    generations=3):
+    results = {}
+    for states in vocabularies:
+        for size in sizes:
+            sample = make_sample(size, states, seed)
+            key = f"train/{size}/{states}"
+            results[key] = bench_training(sample)
+            print(format_result(key, results[key]), flush=True)
+            rules, graph = train(sample)
+            prior = wfc.UnknowState(*graph.values())
+            for mode in modes:
+                key = f"{mode}/{size}/{states}"
+                results[key] = bench_solve(MODES[mode], rules, prior, size, seed, 
+                    attempts, backtracks, memory, generations)
+                print(format_result(key, results[key]), flush=True)
+    return results
+
+
+def format_result(key, result):
+    line = f"{key:<20} {result['nodes_per_second']:>12.0f} nodes/s"
+    if "propagations_per_second" in result:
+        line += (f" {result['propagations_per_second']:>12.0f} props/s"
+            f" p50 {result['p50_generation_ms']:.1f} ms"
+            f" p99 {result['p99_generation_ms']:.1f} ms"
+            f" solved {result['successes']}/{result['generations']}"
+            f" restarts {result['restarts_per_success']:.2f}"
+            f" backtracks {result['backtracks_per_success']:.1f}"
+            f" contradictions {result['contradiction_rate']:.4f}")
+    if "bytes_per_node" in result:
+        line += f" {result['bytes_per_node']:.0f} B/node"
+    return line
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        if result["nodes_per_second"] < old["nodes_per_second"] * (1 - threshold):
+            regressions.append(f"{key}: nodes/s {old['nodes_per_second']:.0f} -> "
+                f"{result['nodes_per_second']:.0f}")
+        if "p99_generation_ms" in old \
+            and result["p99_generation_ms"] > old["p99_generation_ms"] * (1 + threshold):
+            regressions.append(f"{key}: p99 {old['p99_generation_ms']:.1f} ms -> "
+                f"{result['p99_generation_ms']:.1f} ms")
+        if "bytes_per_node" in old and "bytes_per_node" in result \
+            and result["bytes_per_node"] > old["bytes_per_node"] * (1 + threshold):
+            regressions.append(f"{key}: {old['bytes_per_node']:.0f} B/node -> "
+                f"{result['bytes_per_node']:.0f} B/node")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the wfc solver.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[32, 128, 512])
+    parser.add_argument("--states", type=int, nargs="+", default=[4, 16, 40])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--seed", default="0")
+    parser.add_argument("--attempts", type=int, default=8)
+    parser.add_argument("--backtracks", type=int, default=64)
+    parser.add_argument("--generations", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--save", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args.sizes, args.states, args.modes, args.seed, args.attempts, 
+        args.backtracks, not args.no_memory, args.generations)
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
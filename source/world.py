@@ -0,0 +1,424 @@
+import os
+import time
+import heapq
+import random
+import shelve
+import shutil
+import weakref
+import tempfile
+import itertools as it
+from collections import Counter, OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from geometry import Rect, bb2range, iter_cells, rect2bb, rect_contains
+
+
+EntityRecord = namedtuple("EntityRecord", "kind bb tiles")
+ChunkDescription = namedtuple("ChunkDescription", "chunk entities")
+ChunkRecord = namedtuple("ChunkRecord", "description collected revealed")
+
+GROUND_VARIANTS = 4
+
+
+def partition_block(block, seed=0, rows=3, columns=3):
+    rng = random.Random(f"{seed}:block:{block[0]}:{block[1]}")
+    top, left = block[0] * rows, block[1] * columns
+    free = [[True] * columns for _ in range(rows)]
+    rects = []
+    for r, c in it.product(range(rows), range(columns)):
+        if not free[r][c]:
+            continue
+        options = [(height, width) 
+            for height in range(1, rows - r + 1) for width in range(1, columns - c + 1)
+            if all(free[i][j] for i in range(r, r + height) for j in range(c, c + width))]
+        height, width = rng.choice(options)
+        for i, j in it.product(range(r, r + height), range(c, c + width)):
+            free[i][j] = False
+        rects.append(Rect(top + r, left + c, height, width))
+    return rects
+
+
+def rect_containing(row, column, seed=0, rows=3, columns=3):
+    block = row // rows, column // columns
+    for rect in partition_block(block, seed, rows, columns):
+        if rect_contains(rect, row, column):
+            return rect
+
+
+def chunk_rng(chunk, seed=0):
+    row, column, height, width = chunk
+    return random.Random(f"{seed}:chunk:{row}:{column}")
+
+
+def ground_tiles(bb, style, rng=random):
+    left, bottom, right, top = map(round, bb)
+    width, height = right - left, top - bottom
+    y, x = rng.choice(style["ground"])
+    fill = random.Random(f"ground:{y}:{x}:{width}:{height}:{rng.randrange(GROUND_VARIANTS)}")
+    tiles = []
+    if width > 1:
+        if height > 1:
+            tiles.append((top - 1, left, (y + 3, x + 0)))
+            tiles.append((bottom, left, (y + 1, x)))
+            tiles.append((bottom, right - 1, (y + 1, x + 2)))
+            tiles.append((top - 1, right - 1, (y + 3, x + 2)))
+            for column in range(left + 1, right - 1):
+                tiles.append((top - 1, column, (y + 3, x + 1)))
+                tiles.append((bottom, column, (y + 1, x + 1)))
+            for row in range(bottom + 1, top - 1):
+                tiles.append((row, left, (y + 2, x + 0)))
+                tiles.append((row, right - 1, (y + 2, x + 2)))
+            for row, column in it.product(range(bottom + 1, top - 1), range(left + 1, right - 1)):
+                tiles.append((row, column, fill.choice([(y + 2, x + 1), 
+                    (y + 0, x + 4), (y + 1, x + 4), (y + 2, x + 4), (y + 3, x + 4)])))
+        else:
+            tiles.append((bottom, left, (y + 0, x + 0)))
+            tiles.append((bottom, right - 1, (y + 0, x + 2)))
+            for column in range(left + 1, right - 1):
+                tiles.append((bottom, column, (y + 0, x + 1)))
+    elif height > 1:
+        tiles.append((bottom, left, (y + 1, x + 3)))
+        tiles.append((top - 1, left, (y + 3, x + 3)))
+        for row in range(bottom + 1, top - 1):
+            tiles.append((row, left, (y + 2, x + 3)))
+    else:
+        tiles.append((bottom, left, (y + 0, x + 3)))
+    return tuple(tiles)
+
+
+def decoration_top_tiles(bb, style, rng=random):
+    left, bottom, right, top = map(round, bb)
+    height = top - bottom
+    if height == 1:
+        return ((bottom, left, rng.choice(style["top_deco"])),)
+    elif height == 2:
+        if rng.uniform(0, 1) < 0.3:
+            return ((bottom, left, rng.choice(style["top_deco1"])), 
+                (bottom + 1, left, rng.choice(style["top_deco2"])))
+        return ((bottom, left, rng.choice(style["top_deco"])),)
+    return ()
+
+
+def decoration_bottom_tiles(bb, style, rng=random):
+    left, bottom, right, top = map(round, bb)
+    height = top - bottom
+    if height == 1:
+        return ((top - 1, left, rng.choice(style["bottom_deco"])),)
+    elif height == 2:
+        if rng.uniform(0, 1) < 0.3:
+            return ((top - 1, left, rng.choice(style["bottom_deco1"])), 
+                (top - 2, left, rng.choice(style["bottom_deco2"])))
+        return ((top - 1, left, rng.choice(style["bottom_deco"])),)
+    return ()
+
+
+def describe_top(bb, style, rng=random):
+    left, bottom, right, top = map(round, bb)
+    for column in range(left, right):
+        u = rng.uniform(0, 1)
+        if u < 0.3:
+            decoration_bb = (column, bottom, column + 1, top)
+            yield EntityRecord("decoration_top", decoration_bb, 
+                decoration_top_tiles(decoration_bb, style, rng))
+        elif u < 0.7:
+            reward_bb = (column, bottom, column + 1, bottom + 1)
+            yield EntityRecord("gem" if u < 0.6 else "diamond", reward_bb, ())
+        elif u < 0.75:
+            trap_bb = (column, bottom, column + 1, bottom + 1)
+            yield EntityRecord("static_trap" if u < 0.735 else "hidden_trap", trap_bb, ())
+
+
+def describe_bottom(bb, style, rng=random):
+    left, bottom, right, top = map(round, bb)
+    for column in range(left, right):
+        if rng.uniform(0, 1) < 0.2:
+            decoration_bb = (column, bottom, column + 1, top)
+            yield EntityRecord("decoration_bottom", decoration_bb, 
+                decoration_bottom_tiles(decoration_bb, style, rng))
+
+
+def describe_chunk(chunk, style, rows=3, columns=3, rng=random):
+    left, bottom, right, top = rect2bb(chunk, rows, columns, 1, 1)
+
+    new_left = rng.randint(left + 1, min(left + 2, right - 2))
+    new_right = rng.randint(max(new_left, right - 1), right - 1)
+
+    bottom_top = rng.randint(bottom + 1, min(bottom + 3, top - 2))
+    top_bottom = rng.randint(max(bottom_top + 1, top - 2), top - 1)
+
+    bottom_bb = (new_left, bottom, new_right, bottom_top)
+    ground_bb = (new_left, bottom_top, new_right, top_bottom)
+    top_bb = (new_left, top_bottom, new_right, top)
+
+    entities = [*describe_top(top_bb, style, rng)]
+    entities.append(EntityRecord("ground", ground_bb, ground_tiles(ground_bb, style, rng)))
+    entities.extend(describe_bottom(bottom_bb, style, rng))
+    return ChunkDescription(chunk, tuple(entities))
+
+
+class Pool:
+    def __init__(self, capacity=512):
+        self.capacity = capacity
+        self.free = defaultdict(list)
+        self.size = 0
+        self.stats = Counter()
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def hit_rate(self):
+        requests = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / requests if requests else 0.0
+
+    def acquire(self, key, default=None):
+        items = self.free.get(key)
+        if items:
+            self.stats["hits"] += 1
+            self.size -= 1
+            return items.pop()
+        self.stats["misses"] += 1
+        return default
+
+    def release(self, key, item):
+        items = self.free[key]
+        if len(items) < self.capacity:
+            items.append(item)
+            self.size += 1
+            self.stats["released"] += 1
+        else:
+            self.stats["discarded"] += 1
+
+    def clear(self):
+        self.free.clear()
+        self.size = 0
+
+
+def close_spill(spilled, tempdir=None):
+    spilled.close()
+    if tempdir is not None:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+class ChunkCache:
+    def __init__(self, capacity=256, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.records = OrderedDict()
+        self.spilled = None
+        self.tempdir = None
+        self.finalizer = None
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self.records)
+
+    @staticmethod
+    def get_key(chunk):
+        return "{}:{}:{}:{}".format(*chunk)
+
+    def open(self):
+        if self.spilled is None:
+            path = self.path
+            if path is None:
+                self.tempdir = tempfile.mkdtemp(prefix="chunks-")
+                path = os.path.join(self.tempdir, "chunks")
+            self.spilled = shelve.open(path, "n")
+            self.finalizer = weakref.finalize(self, close_spill, self.spilled, self.tempdir)
+        return self.spilled
+
+    def put(self, chunk, record):
+        self.records[chunk] = record
+        self.records.move_to_end(chunk)
+        while len(self.records) > self.capacity:
+            old_chunk, old_record = self.records.popitem(last=False)
+            self.open()[self.get_key(old_chunk)] = old_record
+            self.stats["spilled"] += 1
+
+    def pop(self, chunk, default=None):
+        record = self.records.pop(chunk, None)
+        if record is not None:
+            self.stats["hits"] += 1
+            return record
+        if self.spilled is not None:
+            record = self.spilled.pop(self.get_key(chunk), None)
+            if record is not None:
+                self.stats["spill_hits"] += 1
+                return record
+        self.stats["misses"] += 1
+        return default
+
+    def close(self):
+        self.records.clear()
+        if self.finalizer is not None:
+            self.finalizer()
+            self.finalizer = None
+            self.spilled = None
+            self.tempdir = None
+
+
+class FrameScheduler:
+    def __init__(self, budget=4.0, clock=time.perf_counter):
+        self.budget = budget
+        self.clock = clock
+        self.queue = []
+        self.counter = it.count()
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self.queue)
+
+    def push(self, priority, task, *args):
+        entry = [priority, next(self.counter), task, args]
+        heapq.heappush(self.queue, entry)
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None
+
+    def run(self, budget=None):
+        budget = self.budget if budget is None else budget
+        deadline = self.clock() + budget / 1000
+        ran = 0
+        while self.queue:
+            _, _, task, args = heapq.heappop(self.queue)
+            if task is None:
+                continue
+            task(*args)
+            ran += 1
+            if self.clock() >= deadline:
+                break
+        self.stats["frames"] += 1
+        self.stats["tasks"] += ran
+        if self.clock() > deadline:
+            self.stats["overruns"] += 1
+        return ran
+
+
+class ChunkWorker:
+    def __init__(self, rows=3, columns=3, seed=0):
+        self.rows = rows
+        self.columns = columns
+        self.seed = seed
+        self.executor = None
+
+    def submit(self, chunk, style):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(1, thread_name_prefix="ChunkWorker")
+        return self.executor.submit(describe_chunk, chunk, style, 
+            self.rows, self.columns, chunk_rng(chunk, self.seed))
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+class SpatialHash:
+    def __init__(self, rows=3, columns=3, width=16, height=16):
+        self.rows = rows
+        self.columns = columns
+        self.width = width
+        self.height = height
+        self.buckets = defaultdict(set)
+        self.items = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def get_cells(self, bb):
+        return bb2range(bb, self.columns * self.width, self.rows * self.height)
+
+    def insert(self, item, bb):
+        bounds = self.items[item] = self.get_cells(bb)
+        row_start, row_stop, column_start, column_stop = bounds
+        for cell in it.product(range(row_start, row_stop), range(column_start, column_stop)):
+            self.buckets[cell].add(item)
+
+    def remove(self, item):
+        row_start, row_stop, column_start, column_stop = self.items.pop(item)
+        for cell in it.product(range(row_start, row_stop), range(column_start, column_stop)):
+            bucket = self.buckets[cell]
+            bucket.discard(item)
+            if not bucket:
+                del self.buckets[cell]
+
+    def discard(self, item):
+        if item in self.items:
+            self.remove(item)
+
+    def query(self, bb):
+        row_start, row_stop, column_start, column_stop = self.get_cells(bb)
+        found = set()
+        for cell in it.product(range(row_start, row_stop), range(column_start, column_stop)):
+            bucket = self.buckets.get(cell)
+            if bucket:
+                found |= bucket
+        return found
+
+
+class OccupancyIndex:
+    def __init__(self):
+        self.owners = {}
+        self.visible = set()
+        self.visible_counts = {}
+        self.released = set()
+        self.bounds = None
+
+    def __contains__(self, cell):
+        return cell in self.owners
+
+    def get_owner(self, cell):
+        return self.owners.get(cell)
+
+    def place(self, chunk):
+        count = 0
+        for cell in iter_cells(chunk):
+            self.owners[cell] = chunk
+            count += cell in self.visible
+        self.visible_counts[chunk] = count
+
+    def remove(self, chunk):
+        for cell in iter_cells(chunk):
+            del self.owners[cell]
+        del self.visible_counts[chunk]
+
+    def release(self, chunk):
+        self.remove(chunk)
+        self.released.update(cell for cell in iter_cells(chunk) if cell in self.visible)
+        self.bounds = None
+
+    def update(self, bounds):
+        if bounds == self.bounds:
+            return [], []
+        self.bounds = bounds
+        row_start, row_stop, column_start, column_stop = bounds
+        visible = set(it.product(range(row_start, row_stop),
+            range(column_start, column_stop)))
+        entered = visible - self.visible
+        exited = self.visible - visible
+        self.visible = visible
+
+        owners = self.owners
+        counts = self.visible_counts
+        missing = []
+        for cell in entered:
+            chunk = owners.get(cell)
+            if chunk is None:
+                missing.append(cell)
+            else:
+                counts[chunk] += 1
+        touched = set()
+        for cell in exited:
+            chunk = owners.get(cell)
+            if chunk is not None:
+                counts[chunk] -= 1
+                touched.add(chunk)
+        missing.extend(cell for cell in self.released 
+            if cell in visible and cell not in owners)
+        self.released.clear()
+        stale = [chunk for chunk in touched if counts[chunk] == 0]
+        return stale, missing
@@ -0,0 +1,324 @@
+import gc
+import sys
+import json
+import math
+import time
+import random
+import atexit
+import argparse
+import tracemalloc
+
+import pyglet
+pyglet.options["headless"] = True
+pyglet.options["audio"] = ("silent",)
+pyglet.resource.media = lambda name, streaming=True: pyglet.media.synthesis.Silence(0.1)
+
+import cocos
+import pymunk
+
+import TheForgottenLands as game
+from wfc_benchmark import percentile
+
+atexit.unregister(game.save_hight_scores)
+
+
+class StubSprite:
+    parent = None
+
+    def __init__(self, image, position=(0, 0), scale=1, rows=1, columns=1, **kwargs):
+        self.image = image
+        self.position = position
+        self.scale = scale
+        self.visible = True
+        self.width = columns * game.TILEWIDTH * scale
+        self.height = rows * game.TILEHEIGHT * scale
+
+    def get_AABB(self):
+        x, y = self.position
+        return cocos.rect.Rect(x - self.width / 2, y - self.height / 2,
+            self.width, self.height)
+
+
+def create_tile(row, column, image, pool=None, key=None, **kwargs):
+    sprite = None if pool is None else pool.acquire(key)
+    if sprite is None:
+        sprite = StubSprite(image, **kwargs)
+    game.place_tile(sprite, row, column)
+    return sprite
+
+
+def create_block(row, column, key, pool=None, **kwargs):
+    sprite = None if pool is None else pool.acquire(key)
+    if sprite is None:
+        sprite = StubSprite(key, rows=1 + max(r for r, c, i in key),
+            columns=1 + max(c for r, c, i in key), **kwargs)
+    game.place_block(sprite, row, column)
+    return sprite
+
+game.create_tile = create_tile
+game.create_block = create_block
+
+
+class NullLayer:
+    def add(self, node, z=0, name=None, bb=None):
+        pass
+
+    def remove(self, node):
+        pass
+
+
+class BenchScene:
+    add_entity = game.GameScene.add_entity
+    add_entities = game.GameScene.add_entities
+    has_entity = game.GameScene.has_entity
+    remove_entity = game.GameScene.remove_entity
+    remove_entities = game.GameScene.remove_entities
+
+    def __init__(self, style, static_geometry=game.STATIC_GEOMETRY, 
+        spatial_hash=game.SPATIAL_HASH):
+        self.style = style
+        self.scrollable = NullLayer()
+        self.space = game.create_space(spatial_hash)
+        self.static_geometry = static_geometry
+        self.registry = {}
+        self.shape_owners = {}
+
+
+def straight(frames, speed):
+    x = y = 0
+    for _ in range(frames):
+        x += speed
+        yield x, y
+
+def zigzag(frames, speed, period=120):
+    x = y = 0
+    for frame in range(frames):
+        x += speed
+        y += speed if frame // period % 2 else -speed
+        yield x, y
+
+def fall(frames, speed):
+    x = y = 0
+    for _ in range(frames):
+        y -= 4 * speed
+        yield x, y
+
+def teleport(frames, speed, period=180, distance=20000):
+    x = y = 0
+    for frame in range(frames):
+        x += speed
+        if frame and frame % period == 0:
+            x += distance
+            y -= distance // 2
+        yield x, y
+
+PATHS = {
+    "straight": straight,
+    "zigzag": zigzag,
+    "fall": fall,
+    "teleport": teleport,
+}
+
+PHYSICS_MODES = {
+    "bodies": (False, False),
+    "static": (True, False),
+    "hashed": (True, True),
+}
+
+
+def traverse(path, frames, speed, seed, width, height, fps, memory=False):
+    scene = BenchScene(game.STYLES[0])
+    world = game.WorldGenerator(scene, 3, 3,
+        game.TILEWIDTH * game.SCALE, game.TILEHEIGHT * game.SCALE, seed=seed)
+    world.node_type = NullLayer
+    created = 0
+    create_chunk = world.create_chunk
+    def counted_create_chunk(*args):
+        nonlocal created
+        created += 1
+        create_chunk(*args)
+    world.create_chunk = counted_create_chunk
+
+    times = []
+    entities = []
+    samples = []
+    gc.disable()
+    if memory:
+        tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        for frame, (x, y) in enumerate(PATHS[path](frames, speed)):
+            frame_start = time.perf_counter()
+            scene.space.step(game.STEP)
+            world.update((x, y, x + width, y + height))
+            now = time.perf_counter()
+            times.append(now - frame_start)
+            entities.append(len(scene.registry))
+            if memory and frame % 60 == 0:
+                samples.append(tracemalloc.get_traced_memory()[0])
+            if fps:
+                time.sleep(max(0, 1 / fps - (now - frame_start)))
+        elapsed = time.perf_counter() - start
+        if memory:
+            samples.append(tracemalloc.get_traced_memory()[0])
+            _, peak = tracemalloc.get_traced_memory()
+    finally:
+        if memory:
+            tracemalloc.stop()
+        gc.enable()
+        world.discard()
+
+    result = {
+        "frames": frames,
+        "chunks_created": created,
+        "chunks_per_second": created / sum(times),
+        "seconds": elapsed,
+        "p50_ms": percentile(times, 50) * 1e3,
+        "p99_ms": percentile(times, 99) * 1e3,
+        "max_ms": max(times) * 1e3,
+        "entities": entities[-1],
+        "max_entities": max(entities),
+        **world.get_stats(),
+    }
+    if memory:
+        warm = samples[len(samples) // 4]
+        result["peak_bytes"] = peak
+        result["final_bytes"] = samples[-1]
+        result["growth_bytes"] = samples[-1] - warm
+    return result
+
+
+def step_physics(mode, scale, steps, seed, width, height, probes=16):
+    scene = BenchScene(game.STYLES[0], *PHYSICS_MODES[mode])
+    world = game.WorldGenerator(scene, 3, 3,
+        game.TILEWIDTH * game.SCALE, game.TILEHEIGHT * game.SCALE, seed=seed)
+    world.node_type = NullLayer
+    width, height = width * scale, height * scale
+    try:
+        start = time.perf_counter()
+        world.update((-width / 2, -height / 2, width / 2, height / 2))
+        world.flush()
+        build = time.perf_counter() - start
+
+        rng = random.Random(f"probes:{seed}")
+        size = game.TILEWIDTH * game.SCALE
+        for _ in range(probes):
+            body = pymunk.Body(1, math.inf)
+            body.position = (rng.uniform(-width / 2, width / 2), 
+                rng.uniform(-height / 2, height / 2))
+            scene.space.add(body, pymunk.Poly.create_box(body, (size, size)))
+
+        times = []
+        gc.disable()
+        try:
+            for _ in range(steps):
+                start = time.perf_counter()
+                scene.space.step(game.STEP)
+                times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+        return {
+            "chunks": len(world.chunks),
+            "bodies": len(scene.space.bodies),
+            "shapes": len(scene.space.shapes),
+            "build_ms": build * 1e3,
+            "p50_ms": percentile(times, 50) * 1e3,
+            "p99_ms": percentile(times, 99) * 1e3,
+            "max_ms": max(times) * 1e3,
+        }
+    finally:
+        world.discard()
+
+
+def run_physics(modes, scales, steps, seed, width, height):
+    results = {}
+    for scale in scales:
+        for mode in modes:
+            key = f"physics/{mode}/{scale}"
+            results[key] = step_physics(mode, scale, steps, seed, width, height)
+            print(format_physics(key, results[key]), flush=True)
+    return results
+
+
+def run(paths, frames, speed, seed, width, height, fps, memory=True):
+    results = {}
+    for path in paths:
+        results[path] = traverse(path, frames, speed, seed, width, height, fps)
+        if memory:
+            results[path].update((key, value) for key, value in traverse(path, frames,
+                speed, seed, width, height, 0, True).items() if key.endswith("_bytes"))
+        print(format_result(path, results[path]), flush=True)
+    return results
+
+
+def format_result(key, result):
+    line = (f"{key:<10} {result['chunks_per_second']:>8.1f} chunks/s"
+        f" p50 {result['p50_ms']:.3f} ms p99 {result['p99_ms']:.3f} ms"
+        f" max {result['max_ms']:.3f} ms"
+        f" entities {result['entities']} (max {result['max_entities']})")
+    if "peak_bytes" in result:
+        line += (f" peak {result['peak_bytes'] / 2 ** 20:.1f} MiB"
+            f" growth {result['growth_bytes'] / 2 ** 10:+.0f} KiB")
+    return line
+
+
+def format_physics(key, result):
+    return (f"{key:<20} chunks {result['chunks']:>4} shapes {result['shapes']:>5}"
+        f" bodies {result['bodies']:>5} build {result['build_ms']:.1f} ms"
+        f" step p50 {result['p50_ms']:.3f} ms p99 {result['p99_ms']:.3f} ms"
+        f" max {result['max_ms']:.3f} ms")
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for key, result in results.items():
+        old = baseline.get(key)
+        if old is None:
+            continue
+        for metric in ("p99_ms", "max_ms", "max_entities", "peak_bytes"):
+            if metric in old and metric in result \
+                and result[metric] > old[metric] * (1 + threshold):
+                regressions.append(f"{key}: {metric} {old[metric]:.3f} -> {result[metric]:.3f}")
+        if "growth_bytes" in old and "growth_bytes" in result \
+            and result["growth_bytes"] > old["growth_bytes"] + old["peak_bytes"] * threshold:
+            regressions.append(f"{key}: growth_bytes {old['growth_bytes']} -> "
+                f"{result['growth_bytes']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark world streaming headlessly.")
+    parser.add_argument("--paths", nargs="+", choices=PATHS, default=list(PATHS))
+    parser.add_argument("--frames", type=int, default=3600)
+    parser.add_argument("--speed", type=float, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--size", type=int, nargs=2, default=[1920, 1080])
+    parser.add_argument("--fps", type=float, default=60)
+    parser.add_argument("--no-memory", action="store_true")
+    parser.add_argument("--physics", nargs="*", choices=PHYSICS_MODES, metavar="MODE",
+        help="also time space.step against live chunk count for these modes")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--steps", type=int, default=600)
+    parser.add_argument("--save", metavar="PATH")
+    parser.add_argument("--baseline", metavar="PATH")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args.paths, args.frames, args.speed, args.seed, *args.size,
+        args.fps, not args.no_memory)
+    if args.physics is not None:
+        results.update(run_physics(args.physics or list(PHYSICS_MODES), args.scales, 
+            args.steps, args.seed, *args.size))
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()